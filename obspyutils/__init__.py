@@ -12,12 +12,14 @@ __all__ = [
     "cusp",
     "event",
     "hypodd",
+    "lazy",
     "metadata",
     "momenttensor",
     "noise",
     "pylith",
     "rotate",
     "specfem",
+    "store",
     "subset",
 ]
 
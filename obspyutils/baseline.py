@@ -5,6 +5,12 @@
 #
 # ======================================================================
 
+import bisect
+import collections
+import functools
+import math
+import os
+
 import numpy
 import obspy
 import scipy.optimize
@@ -53,80 +59,738 @@ def _correctionV0(acc, tpre, ttail):
     
 
 # ----------------------------------------------------------------------
-def baseline_correction_v0(stream, originTime, ttail=None):
+def _correctionV0Batch(acc, dt, tpre, ttail):
+    """
+    Apply V0 correction to a 2-D array (ntraces, npts) of acceleration
+    records with a common time step. Equivalent to _correctionV0 for
+    each row, but the tail fit is a closed-form linear least squares
+    solve across all rows.
+    """
+    ntraces, npts = acc.shape
+    times = numpy.arange(npts) / (1.0/dt) # same as Trace.times()
+
+    # Remove pre-event mean
+    ipre = numpy.argmax(times >= tpre[:,None], axis=1)
+    mask = numpy.arange(npts) < ipre[:,None]
+    acc -= (numpy.sum(numpy.where(mask, acc, 0.0), axis=1) / ipre)[:,None]
+
+    vel = scipy.integrate.cumulative_trapezoid(acc, dx=dt, axis=1, initial=0.0)
+    t = times - tpre[:,None]
+
+    # Fit line to tail of velocity records (same model as _linearvel)
+    t2 = t[:,-1] - ttail
+    mask = t >= t2[:,None]
+    numFit = numpy.sum(mask, axis=1)
+    tmean = numpy.sum(numpy.where(mask, t, 0.0), axis=1) / numFit
+    vmean = numpy.sum(numpy.where(mask, vel, 0.0), axis=1) / numFit
+    tc = numpy.where(mask, t - tmean[:,None], 0.0)
+    af = numpy.sum(tc*vel, axis=1) / numpy.sum(tc*tc, axis=1)
+    v0 = vmean + af*(t[:,-1] - 30.0 - tmean)
+    del vel, tc
+
+    # Average acceleration in strong part of record
+    i1 = numpy.argmax(numpy.abs(acc) >= 0.05, axis=1)
+    t1 = t[numpy.arange(ntraces), i1]
+    am = v0 / (t2-t1)
+
+    mask = numpy.bitwise_and(t > t1[:,None], t <= t2[:,None])
+    acc -= mask * am[:,None]
+
+    mask = t > t2[:,None]
+    acc -= mask * af[:,None]
+
+    return
+
+
+# ----------------------------------------------------------------------
+def _groupBySampling(traces):
+    """
+    Group traces with the same number of points and time step.
+    """
+    groups = collections.OrderedDict()
+    for tr in traces:
+        key = (tr.stats.npts, tr.stats.delta)
+        if not key in groups:
+            groups[key] = []
+        groups[key].append(tr)
+    return groups
+
+
+# ----------------------------------------------------------------------
+def _sharedWorker(funcName, blockNames, specs, args):
+    """
+    Apply baseline function to traces whose data live in shared memory.
+
+    Each entry in specs is (offset, npts, stats) for one trace. Traces
+    corrected in place are written back to the first block; output
+    streams are written to the remaining blocks.
+    """
+    from multiprocessing import shared_memory
+
+    blocks = [shared_memory.SharedMemory(name=name) for name in blockNames]
+    buffers = traces = outputs = result = None
+    try:
+        size = blocks[0].size // 8
+        buffers = [numpy.ndarray((size,), dtype=numpy.float64, buffer=block.buf) for block in blocks]
+        traces = []
+        for offset,npts,stats in specs:
+            traces.append(obspy.core.Trace(data=buffers[0][offset:offset+npts], header=stats))
+        result = globals()[funcName](obspy.core.Stream(traces=traces), *args)
+
+        if result is None:
+            outputs = [traces]
+        elif isinstance(result, obspy.core.Stream):
+            outputs = [[], result.traces]
+        else:
+            outputs = [[]] + [s.traces for s in result]
+        for buf,outTraces in zip(buffers, outputs):
+            for (offset,npts,stats),tr in zip(specs, outTraces):
+                if not numpy.shares_memory(tr.data, buf):
+                    buf[offset:offset+npts] = tr.data
+    finally:
+        buffers = traces = outputs = result = None
+        for block in blocks:
+            block.close()
+    return
+
+
+# ----------------------------------------------------------------------
+def _mapShared(funcName, stream, workers, args=(), numOutputs=0, inplace=False):
+    """
+    Split stream across a pool of processes with trace data passed
+    through shared memory.
+
+    Data are passed as float64, so traces corrected in place must have
+    floating point data.
+
+    :param workers: Number of worker processes or a concurrent.futures executor.
+    :param numOutputs: Number of output streams returned by function (0 if traces are corrected in place).
+    :param inplace: If True, the first output stream is written to the input traces, which are returned in its place.
+    :returns: None if traces are corrected in place, otherwise the output stream(s) in the original trace order.
+    """
+    import concurrent.futures
+    from multiprocessing import shared_memory
+
+    traces = stream.traces
+    if numOutputs == 0 or inplace:
+        for tr in traces:
+            if not numpy.issubdtype(tr.data.dtype, numpy.floating):
+                raise TypeError("Cannot correct trace '%s' with data of type %s in place. Convert data to floating point." % (tr.id, tr.data.dtype))
+    if len(traces) == 0:
+        if numOutputs == 0:
+            return None
+        streams = [obspy.core.Stream() for i in range(numOutputs)]
+        if inplace:
+            streams[0] = stream
+        return streams[0] if numOutputs == 1 else tuple(streams)
+
+    offsets = numpy.cumsum([0] + [tr.stats.npts for tr in traces])
+    size = max(1, int(offsets[-1]))
+    blocks = []
+    data = out = None
+    try:
+        for i in range(1+numOutputs):
+            blocks.append(shared_memory.SharedMemory(create=True, size=8*size))
+        data = numpy.ndarray((size,), dtype=numpy.float64, buffer=blocks[0].buf)
+        for tr,offset in zip(traces, offsets):
+            data[offset:offset+tr.stats.npts] = tr.data
+
+        if isinstance(workers, concurrent.futures.Executor):
+            executor = workers
+            numChunks = os.cpu_count() or 1
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            numChunks = workers
+        blockNames = [block.name for block in blocks]
+        futures = []
+        for chunk in numpy.array_split(numpy.arange(len(traces)), min(numChunks, len(traces))):
+            specs = [(int(offsets[i]), traces[i].stats.npts, traces[i].stats) for i in chunk]
+            futures.append(executor.submit(_sharedWorker, funcName, blockNames, specs, args))
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            if not executor is workers:
+                executor.shutdown()
+
+        if numOutputs == 0:
+            for tr,offset in zip(traces, offsets):
+                tr.data[:] = data[offset:offset+tr.stats.npts]
+            result = None
+        else:
+            streams = []
+            for block in blocks[1:]:
+                out = numpy.ndarray((size,), dtype=numpy.float64, buffer=block.buf)
+                if inplace and not streams:
+                    for tr,offset in zip(traces, offsets):
+                        tr.data[:] = out[offset:offset+tr.stats.npts]
+                    streams.append(stream)
+                    continue
+                tracesOut = []
+                for tr,offset in zip(traces, offsets):
+                    tracesOut.append(obspy.core.Trace(data=out[offset:offset+tr.stats.npts].copy(), header=tr.stats.copy()))
+                streams.append(obspy.core.Stream(traces=tracesOut))
+            result = streams[0] if numOutputs == 1 else tuple(streams)
+    finally:
+        data = out = None
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return result
+
+
+# ----------------------------------------------------------------------
+def baseline_correction_v0(stream, originTime, ttail=None, batch=False, workers=None):
+    """
+    Apply Boore (1999) V0 baseline correction to traces in place.
+
+    :type originTime: obspy.UTCDateTime
+    :param originTime: Origin time of event.
+    :type ttail: float
+    :param ttail: Duration of tail of velocity record used in fit. Default is pre-event duration of first trace.
+    :type batch: bool
+    :param batch: If True, stack traces with the same number of points and time step and correct them together.
+    :type workers: int or concurrent.futures.Executor
+    :param workers: Number of worker processes or executor used to correct traces in parallel. Default is serial.
+    """
+    if not ttail and len(stream.traces) > 0:
+        ttail = originTime - stream.traces[0].stats.starttime
+    if workers:
+        _mapShared("baseline_correction_v0", stream, workers, (originTime, ttail, batch))
+        return
+
+    if batch:
+        for (npts, dt),traces in _groupBySampling(stream.traces).items():
+            acc = numpy.array([tr.data for tr in traces], dtype=numpy.float64)
+            tpre = numpy.array([originTime - tr.stats.starttime for tr in traces])
+            _correctionV0Batch(acc, dt, tpre, ttail)
+            for tr,data in zip(traces, acc):
+                tr.data[:] = data
+        return
+
     for tr in stream.traces:
         tpre = originTime - tr.stats.starttime
-        if not ttail:
-            ttail = tpre
         _correctionV0(tr, tpre, ttail)
     return
 
 
 # ----------------------------------------------------------------------
-def baseline_correction_spline(stream, window=2.0):
+# IncrementalV0
+class IncrementalV0(object):
+    """
+    Boore (1999) V0 baseline correction for a record that arrives in
+    packets.
+
+    Running sums for the pre-event mean and for the line fit to the
+    tail of the velocity record are updated with each packet, so
+    update() costs O(packet). The corrected record is the same as
+    baseline_correction_v0() applied to the samples received so far.
+
+    corrected() returns corrected samples of the latest packet (or any
+    range of samples) in O(packet) work, while trace() costs O(n) in
+    the number of samples received. parameters() also costs O(n) while
+    the pre-event window is incomplete (the start of the strong part is
+    found by rescanning all samples with the provisional mean);
+    otherwise it costs O(1).
+    """
+
+    def __init__(self, header, originTime, ttail=None):
+        """
+        Constructor.
+
+        :type header: dict or obspy.core.Stats
+        :param header: Trace header with at least starttime and delta.
+        :type originTime: obspy.UTCDateTime
+        :param originTime: Origin time of event.
+        :type ttail: float
+        :param ttail: Duration of tail of velocity record used in fit. Default is pre-event duration.
+        """
+        self.stats = obspy.core.Stats(header)
+        self.dt = self.stats.delta
+        self.samplingRate = self.stats.sampling_rate
+        self.tpre = originTime - self.stats.starttime
+        self.ttail = ttail or self.tpre
+        self.npts = 0
+
+        self._packets = []
+        self._packetStarts = []
+        self._accLast = 0.0
+        self._velLast = 0.0
+        self._preSum = 0.0
+        self._preCount = 0
+        self._preDone = False
+        self._i1 = None
+        self._scanPacket = 0
+        self._scanOffset = 0
+
+        # Chunks of raw velocity (pre-event mean not removed) in tail
+        # and sums (n, t, t**2, v, t*v) over tail.
+        self._tail = collections.deque()
+        self._tailSums = numpy.zeros(5)
+        return
+
+
+    def update(self, data):
+        """
+        Add packet of acceleration samples following previous packets.
+        """
+        data = numpy.asarray(data, dtype=numpy.float64)
+        numNew = data.shape[0]
+        if numNew == 0:
+            return
+        i0 = self.npts
+        times = (i0 + numpy.arange(numNew)) / self.samplingRate
+
+        # Pre-event sums
+        if not self._preDone:
+            post = times >= self.tpre
+            numPre = numpy.argmax(post) if post[-1] else numNew
+            self._preSum += numpy.sum(data[:numPre])
+            self._preCount += numPre
+            self._preDone = numPre < numNew
+
+        # Raw velocity via trapezoidal rule
+        pairs = numpy.empty(numNew)
+        pairs[0] = self._accLast + data[0] if i0 > 0 else 0.0
+        pairs[1:] = data[1:] + data[:-1]
+        vel = self._velLast + 0.5*self.dt*numpy.cumsum(pairs)
+        self._accLast = data[-1]
+        self._velLast = vel[-1]
+
+        self._packets.append(data)
+        self._packetStarts.append(i0)
+        self.npts += numNew
+
+        # Add packet to tail and drop samples that are no longer in it.
+        t = times - self.tpre
+        self._tail.append((i0, vel))
+        self._tailSums += self._sums(t, vel)
+        t2 = t[-1] - self.ttail
+        while self._tail:
+            j0, velOld = self._tail[0]
+            tOld = (j0 + numpy.arange(velOld.shape[0])) / self.samplingRate - self.tpre
+            keep = tOld >= t2
+            numOld = numpy.argmax(keep) if keep[-1] else keep.shape[0]
+            if numOld == 0:
+                break
+            self._tailSums -= self._sums(tOld[:numOld], velOld[:numOld])
+            self._tail.popleft()
+            if numOld < keep.shape[0]:
+                self._tail.appendleft((j0+numOld, velOld[numOld:]))
+                break
+
+        if self._preDone and self._i1 is None:
+            (self._i1, self._scanPacket, self._scanOffset) = \
+                self._firstExceedance(self._mean(), self._scanPacket, self._scanOffset)
+        return
+
+
+    def parameters(self):
+        """
+        Get current correction parameters.
+
+        :returns: Tuple (mean, v0, af, t1, t2) with pre-event mean,
+        velocity and slope of line fit to tail of velocity record, and
+        start and end of strong part of record relative to origin time.
+        """
+        mean = self._mean()
+        (n, st, stt, svRaw, stvRaw) = self._tailSums
+
+        # Remove pre-event mean from raw velocity, v = vRaw - mean*(t+tpre)
+        sv = svRaw - mean*(st + n*self.tpre)
+        stv = stvRaw - mean*(stt + self.tpre*st)
+        tmean = st / n
+        vmean = sv / n
+        af = (stv/n - tmean*vmean) / (stt/n - tmean*tmean)
+        tLast = (self.npts-1) / self.samplingRate - self.tpre
+        v0 = vmean + af*(tLast - 30.0 - tmean)
+
+        i1 = self._i1
+        if i1 is None and not self._preDone:
+            # Mean is provisional until pre-event window is complete.
+            i1 = self._firstExceedance(mean, 0, 0)[0]
+        t1 = (i1 or 0)*self.dt - self.tpre
+        t2 = tLast - self.ttail
+        return (mean, v0, af, t1, t2)
+
+
+    def trace(self):
+        """
+        Get corrected trace for samples received so far.
+        """
+        data = numpy.concatenate(self._packets) if self._packets else numpy.zeros(0)
+        self._correct(data, 0, self.parameters())
+
+        stats = self.stats.copy()
+        stats.npts = self.npts
+        return obspy.core.Trace(data=data, header=stats)
+
+
+    def corrected(self, start=None, end=None):
+        """
+        Get corrected samples [start, end) with the current correction
+        parameters, the same as trace().data[start:end].
+
+        :type start: int
+        :param start: Index of first sample. Default is first sample of latest packet.
+        :type end: int
+        :param end: Index after last sample. Default is number of samples received.
+        """
+        if start is None:
+            start = self._packetStarts[-1] if self._packets else 0
+        if end is None:
+            end = self.npts
+        start = max(0, start)
+        end = max(start, min(end, self.npts))
+
+        ipacket = max(0, bisect.bisect_right(self._packetStarts, start)-1)
+        chunks = []
+        index = start
+        while index < end:
+            packetStart = self._packetStarts[ipacket]
+            packet = self._packets[ipacket]
+            chunks.append(packet[index-packetStart:end-packetStart])
+            index = packetStart + packet.shape[0]
+            ipacket += 1
+        data = numpy.concatenate(chunks) if chunks else numpy.zeros(0)
+        self._correct(data, start, self.parameters())
+        return data
+
+
+    def _correct(self, data, start, parameters):
+        """
+        Apply correction with parameters (mean, v0, af, t1, t2) in place
+        to samples whose first sample has index start.
+        """
+        (mean, v0, af, t1, t2) = parameters
+        data -= mean
+        t = (start + numpy.arange(data.shape[0])) / self.samplingRate - self.tpre
+
+        am = v0 / (t2-t1)
+        mask = numpy.bitwise_and(t > t1, t <= t2)
+        data[mask] -= am
+        mask = t > t2
+        data[mask] -= af
+        return
+
+
+    def _mean(self):
+        """
+        Mean of pre-event samples (0 if there are none).
+        """
+        return self._preSum / self._preCount if self._preCount > 0 else 0.0
+
+
+    def _sums(self, t, v):
+        """
+        Sufficient statistics for line fit.
+        """
+        return numpy.array([t.shape[0], numpy.sum(t), numpy.dot(t, t), numpy.sum(v), numpy.dot(t, v)])
+
+
+    def _firstExceedance(self, mean, ipacket, offset):
+        """
+        Find first sample with |acc-mean| >= 0.05, scanning packets
+        from ipacket, whose first sample has index offset.
+
+        :returns: Tuple (index of sample or None, index of next packet
+        to scan, index of first sample in that packet).
+        """
+        while ipacket < len(self._packets):
+            packet = self._packets[ipacket]
+            exceed = numpy.abs(packet - mean) >= 0.05
+            if numpy.any(exceed):
+                return (offset + numpy.argmax(exceed), ipacket, offset)
+            ipacket += 1
+            offset += packet.shape[0]
+        return (None, ipacket, offset)
+
+
+# ----------------------------------------------------------------------
+def _splineBaseline(data, dt, window):
+    """
+    Fit degree 5 least squares spline with knot spacing of 0.1*window
+    to data and return the spline evaluated at the data points.
+    """
+    npts = data.shape[0]
+    t = numpy.arange(npts) / (1.0/dt)
+    knotsN = int(0.1*window/dt)
+    knots = numpy.linspace(t[knotsN//2], t[-knotsN//2], npts//knotsN)
+    spline = scipy.interpolate.LSQUnivariateSpline(t, data, t=knots, k=5)
+    return spline(t)
+
+
+# ----------------------------------------------------------------------
+def baseline_correction_spline_blocks(data, dt, window=2.0, block=600.0, overlap=None):
+    """
+    Generator for spline baseline correction of long records in
+    overlapping blocks. A local spline is fit to each block and the
+    local baselines are blended with linear tapers across the
+    overlaps. Only the current block is held in memory, so data may be
+    a memory mapped array.
+
+    :type data: numpy.ndarray
+    :param data: Waveform samples.
+    :type dt: float
+    :param dt: Time step.
+    :type window: float
+    :param window: Window controlling knot spacing (0.1*window) of splines.
+    :type block: float
+    :param block: Duration of each block.
+    :type overlap: float
+    :param overlap: Duration of overlap between blocks. Default is 0.1*block.
+    :returns: Iterator over (index of first sample, corrected samples) for consecutive segments of the record.
+    """
+    if overlap is None:
+        overlap = 0.1*block
+    npts = data.shape[0]
+    blockN = max(1, int(block/dt))
+    overlapN = min(int(overlap/dt), blockN//2)
+    step = blockN - overlapN
+    taper = numpy.linspace(0.0, 1.0, overlapN+2)[1:-1]
+
+    offset = 0
+    sumBaseline = numpy.zeros(0)
+    sumWeight = numpy.zeros(0)
+    start = 0
+    while True:
+        end = start + blockN
+        last = npts - end < blockN//2
+        if last:
+            end = npts
+        baseline = _splineBaseline(data[start:end], dt, window)
+
+        weight = numpy.ones(end-start)
+        if start > 0:
+            weight[:overlapN] = taper
+        if not last and overlapN > 0:
+            weight[-overlapN:] = taper[::-1]
+
+        size = end - offset
+        if sumBaseline.shape[0] < size:
+            sumBaseline = numpy.concatenate((sumBaseline, numpy.zeros(size-sumBaseline.shape[0])))
+            sumWeight = numpy.concatenate((sumWeight, numpy.zeros(size-sumWeight.shape[0])))
+        sumBaseline[start-offset:end-offset] += weight*baseline
+        sumWeight[start-offset:end-offset] += weight
+
+        # Samples before the start of the next block are complete.
+        final = npts if last else start + step
+        numFinal = final - offset
+        yield (offset, data[offset:final] - sumBaseline[:numFinal]/sumWeight[:numFinal])
+        if last:
+            break
+        sumBaseline = sumBaseline[numFinal:]
+        sumWeight = sumWeight[numFinal:]
+        offset = final
+        start = final
+    return
+
+
+# ----------------------------------------------------------------------
+def baseline_correction_spline(stream, window=2.0, block=None, overlap=None, workers=None):
+    """
+    Remove baseline from traces in place using a degree 5 least squares
+    spline with knot spacing of 0.1*window.
+
+    :type block: float
+    :param block: If given, fit local splines on blocks of this duration and blend them (see baseline_correction_spline_blocks).
+    :type overlap: float
+    :param overlap: Duration of overlap between blocks. Default is 0.1*block.
+    :type workers: int or concurrent.futures.Executor
+    :param workers: Number of worker processes or executor used to correct traces in parallel. Default is serial.
+    """
+    if workers:
+        _mapShared("baseline_correction_spline", stream, workers, (window, block, overlap))
+        return
+
     for tr in stream.traces:
-        t = tr.times()
-        knotsN = int(0.1*window*tr.stats.sampling_rate)
-        knots = numpy.linspace(t[knotsN/2], t[-knotsN/2], len(t)/knotsN)
-        spline = scipy.interpolate.LSQUnivariateSpline(tr.times(), tr.data, t=knots, k=5)
-        tr.data -= spline(t)
+        if block:
+            for i0,corrected in baseline_correction_spline_blocks(tr.data, tr.stats.delta, window, block, overlap):
+                tr.data[i0:i0+corrected.shape[0]] = corrected
+        else:
+            tr.data -= _splineBaseline(tr.data, tr.stats.delta, window)
     return
 
 
 # ----------------------------------------------------------------------
-def correction_preonly(data, preevent_window=10.0):
+def _cumtrapzTranspose(y, dt):
+    """
+    Apply transpose of cumtrapz(dx=dt, initial=0.0) to y.
+    """
+    after = numpy.zeros(y.shape[0])
+    after[:-1] = numpy.cumsum(y[:0:-1])[::-1]
+    out = after.copy()
+    out[1:] += after[:-1]
+    out *= 0.5*dt
+    return out
+
+
+# ----------------------------------------------------------------------
+@functools.lru_cache(maxsize=16)
+def _offsetOperator(npts, dt, degree):
+    """
+    Least squares projection giving the constant acceleration offset
+    from npts samples of acceleration: the leading coefficient (times
+    degree!) of a polynomial of the given degree fit to the acceleration
+    integrated degree times (velocity for degree 1, displacement for
+    degree 2).
+
+    Operators are cached, so traces with the same sampling reduce to a
+    dot product.
+    """
+    t = numpy.arange(npts) / (1.0/dt) # same as Trace.times()
+    duration = t[-1]
+    vandermonde = numpy.vander(t / duration, degree+1)
+    op = numpy.linalg.pinv(vandermonde)[0] * (math.factorial(degree) / duration**degree)
+    for i in range(degree):
+        op = _cumtrapzTranspose(op, dt)
+    op.flags.writeable = False
+    return op
+
+
+# ----------------------------------------------------------------------
+def correction_preonly_array(data, dt, preevent_window=10.0):
+    """
+    Apply correction_preonly() in place to each row of a 2-D array
+    (ntraces, npts) of acceleration records with time step dt.
+    """
+    numPreWindow = min(1+int(preevent_window/dt), data.shape[-1])
+    op = _offsetOperator(numPreWindow, dt, 1)
+    data -= numpy.dot(data[...,:numPreWindow], op)[...,None]
+    return
+
+
+# ----------------------------------------------------------------------
+def correction_preonly(data, preevent_window=10.0, workers=None):
         if isinstance(data, obspy.core.Stream):
+            if workers:
+                _mapShared("correction_preonly", data, workers, (preevent_window,))
+                return
             for tr in data:
                 correction_preonly(tr, preevent_window)
         else:
-            dt = data.stats.delta
-            numPreWindow = 1+int(preevent_window/dt)
-
-            poly = numpy.polyfit(data.times()[:numPreWindow], scipy.integrate.cumtrapz(data.data[:numPreWindow], dx=dt, initial=0.0), deg=1)
-            data.data -= poly[0]
+            correction_preonly_array(data.data, data.stats.delta, preevent_window)
         return
 
 # ----------------------------------------------------------------------
-def correction_constant(data):
+def correction_constant_array(data, dt):
+    """
+    Apply correction_constant() in place to each row of a 2-D array
+    (ntraces, npts) of acceleration records with time step dt.
+    """
+    op = _offsetOperator(data.shape[-1], dt, 2)
+    data -= numpy.dot(data, op)[...,None]
+    return
+
+
+# ----------------------------------------------------------------------
+def correction_constant(data, workers=None):
         if isinstance(data, obspy.core.Stream):
+            if workers:
+                _mapShared("correction_constant", data, workers)
+                return
             for tr in data:
                 correction_constant(tr)
         else:
-            dt = data.stats.delta
-            vel = scipy.integrate.cumtrapz(data.data, dx=dt, initial=0.0)
-            disp = scipy.integrate.cumtrapz(vel, dx=dt, initial=0.0)
-            poly = numpy.polyfit(data.times(), disp, deg=2)
-            data.data -= 2.0*poly[0]
+            correction_constant_array(data.data, data.stats.delta)
         return
 
 # ----------------------------------------------------------------------
-def integrate_acc(data):
+def _cumtrapz(y, dt, out, work):
+    """
+    Cumulative trapezoidal integration of y into out with an initial
+    value of 0, like cumtrapz(y, dx=dt, initial=0.0). The work array
+    holds the pairwise sums, so out may be the same array as y.
+    """
+    numpy.add(y[1:], y[:-1], out=work[1:])
+    out[0] = 0.0
+    numpy.cumsum(work[1:], out=out[1:])
+    out[1:] *= 0.5*dt
+    return out
+
+
+# ----------------------------------------------------------------------
+def _polyfitNormalized(y, x, work, deg):
+    """
+    Least squares polynomial fit of y at normalized times x (0 <= x <=
+    1) via the normal equations. Returns coefficients in increasing
+    powers of x. The work array is used as scratch space.
+    """
+    moments = numpy.zeros(2*deg+1)
+    rhs = numpy.zeros(deg+1)
+    work[:] = 1.0
+    for k in range(2*deg+1):
+        moments[k] = numpy.sum(work)
+        if k <= deg:
+            rhs[k] = numpy.dot(work, y)
+        work *= x
+    gram = numpy.array([moments[j:j+deg+1] for j in range(deg+1)])
+    return numpy.linalg.lstsq(gram, rhs, rcond=None)[0]
+
+
+# ----------------------------------------------------------------------
+def _removePoly(y, coefs, x, work):
+    """
+    Subtract polynomial with coefficients in increasing powers of x
+    from y in place. The work array is used as scratch space.
+    """
+    work[:] = coefs[-1]
+    for c in coefs[-2::-1]:
+        work *= x
+        work += c
+    y -= work
+    return
+
+
+# ----------------------------------------------------------------------
+def integrate_acc(data, inplace=False, workers=None):
         """
+        Integrate acceleration to velocity and displacement and remove
+        quadratic trend in displacement (linear trend in velocity).
+
+        Integration and detrending are done in preallocated arrays and
+        output traces share the header values of the input trace
+        rather than being full copies.
+
+        :type inplace: bool
+        :param inplace: If True, overwrite the acceleration with the velocity and return the input trace(s) as the velocity trace(s). Requires floating point data.
+        :type workers: int or concurrent.futures.Executor
+        :param workers: Number of worker processes or executor used for streams. Default is serial.
+        :returns: Tuple of velocity and displacement traces (or streams).
         """
         if isinstance(data, obspy.core.Stream):
+            if workers:
+                return _mapShared("integrate_acc", data, workers, numOutputs=2, inplace=inplace)
             tracesVel = []
             tracesDisp = []
-            for tr in stream:
-                trVel,trDisp = integrate_acc(tr)
+            for tr in data:
+                trVel,trDisp = integrate_acc(tr, inplace)
                 tracesVel.append(trVel)
                 tracesDisp.append(trDisp)
             return (obspy.core.Stream(traces=tracesVel), obspy.core.Stream(traces=tracesDisp),)
         else:
+            npts = data.stats.npts
             dt = data.stats.delta
-            t = data.times()
-            vel = scipy.integrate.cumtrapz(data.data, dx=dt, initial=0.0)
-            disp = scipy.integrate.cumtrapz(vel, dx=dt, initial=0.0)
-            poly = numpy.polyfit(t, disp, deg=2)
-            # poly[0] should be 0 if we have a good baseline correction
-            
-            vel -= 2.0*poly[0]*t + poly[1]
-            disp -= poly[0]*t**2 + poly[1]*t + poly[2]
+            vel = data.data if inplace else numpy.empty(npts)
+            disp = numpy.empty(npts)
+            work = numpy.empty(npts)
+            _cumtrapz(data.data, dt, vel, work)
+            _cumtrapz(vel, dt, disp, work)
 
-            trVel = data.copy()
-            trVel.data = vel
+            # Fit quadratic in normalized time x = t / duration
+            duration = max(npts-1, 1)*dt
+            x = numpy.linspace(0.0, 1.0, npts)
+            poly = _polyfitNormalized(disp, x, work, deg=2)
+            # poly[2] should be 0 if we have a good baseline correction
 
-            trDisp = data.copy()
-            trDisp.data = disp
+            _removePoly(vel, (poly[1]/duration, 2.0*poly[2]/duration), x, work)
+            _removePoly(disp, poly, x, work)
+
+            if inplace:
+                trVel = data
+            else:
+                trVel = obspy.core.Trace(data=vel, header=data.stats)
+            trDisp = obspy.core.Trace(data=disp, header=data.stats)
 
             return (trVel, trDisp,)
             
@@ -134,26 +798,43 @@ def integrate_acc(data):
 
 
 # ----------------------------------------------------------------------
-def integrate_vel(data):
+def integrate_vel(data, inplace=False, workers=None):
         """
+        Integrate velocity to displacement and remove linear trend.
+
+        :type inplace: bool
+        :param inplace: If True, overwrite the velocity with the displacement and return the input trace(s). Requires floating point data.
+        :type workers: int or concurrent.futures.Executor
+        :param workers: Number of worker processes or executor used for streams. Default is serial.
+        :returns: Displacement trace (or stream).
         """
         if isinstance(data, obspy.core.Stream):
+            if workers:
+                return _mapShared("integrate_vel", data, workers, numOutputs=1, inplace=inplace)
             tracesDisp = []
-            for tr in stream:
-                trDisp = integrate_vel(tr)
+            for tr in data:
+                trDisp = integrate_vel(tr, inplace)
                 tracesDisp.append(trDisp)
             return obspy.core.Stream(traces=tracesDisp)
         else:
+            npts = data.stats.npts
             dt = data.stats.delta
-            t = data.times()
-            disp = scipy.integrate.cumtrapz(data.data, dx=dt, initial=0.0)
-            poly = numpy.polyfit(t, disp, deg=1)
-            
-            disp -= 2.0*poly[0]*t + poly[1]
-            disp -= poly[0]
+            disp = data.data if inplace else numpy.empty(npts)
+            work = numpy.empty(npts)
+            _cumtrapz(data.data, dt, disp, work)
+
+            duration = max(npts-1, 1)*dt
+            x = numpy.linspace(0.0, 1.0, npts)
+            poly = _polyfitNormalized(disp, x, work, deg=1)
+
+            # Same correction as disp -= 2*slope*t + intercept + slope
+            slope = poly[1]/duration
+            _removePoly(disp, (poly[0]+slope, 2.0*poly[1]), x, work)
 
-            trDisp = data.copy()
-            trDisp.data = disp
+            if inplace:
+                trDisp = data
+            else:
+                trDisp = obspy.core.Trace(data=disp, header=data.stats)
 
             return trDisp
             
@@ -8,7 +8,87 @@
 import obspy
 import numpy
 import datetime
+import fnmatch
+import glob
+import hashlib
+import json
+import logging
 import math
+import os
+
+# ======================================================================
+# _MappedLines
+class _MappedLines(object):
+  """
+  Lines of a memory-mapped text file.
+
+  Line boundaries are located in one pass over the bytes, and blocks of
+  fixed-width numeric fields are decoded with vectorized operations on
+  the mapped bytes.
+  """
+
+  def __init__(self, filename):
+    """
+    Constructor.
+    """
+    self.raw = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+    size = self.raw.shape[0]
+    newlines = numpy.flatnonzero(self.raw == ord('\n'))
+    self.starts = numpy.concatenate(([0], newlines+1))
+    self.ends = numpy.concatenate((newlines, [size]))
+    if self.starts[-1] == size:
+      self.starts = self.starts[:-1]
+      self.ends = self.ends[:-1]
+    # Drop carriage returns at end of lines.
+    cr = numpy.logical_and(self.ends > self.starts,
+                           self.raw[numpy.maximum(self.ends-1, 0)] == ord('\r'))
+    self.ends -= cr
+    return
+
+
+  def __len__(self):
+    return self.starts.shape[0]
+
+
+  def __getitem__(self, i):
+    return self.raw[self.starts[i]:self.ends[i]].tobytes().decode("latin-1")
+
+
+  def values(self, start, size, width=8, count=10):
+    """
+    Decode fixed-width numeric fields in lines [start, start+size).
+    Blank fields are returned as NaN.
+    """
+    ncols = width*count
+    lineStarts = self.starts[start:start+size]
+    lineLens = self.ends[start:start+size] - lineStarts
+
+    stride = lineStarts[1]-lineStarts[0] if size > 1 else 0
+    if size > 1 and stride >= ncols and \
+          numpy.all(lineLens[:-1] >= ncols) and \
+          numpy.all(numpy.diff(lineStarts) == stride):
+      # Regular lines: view all but the last line as 2-D array.
+      rows = self.raw[lineStarts[0]:lineStarts[0]+stride*(size-1)]
+      rows = rows.reshape(size-1, stride)[:,:ncols]
+      chars = numpy.concatenate((rows, self._pad(lineStarts[-1:], lineLens[-1:], ncols)))
+    else:
+      chars = self._pad(lineStarts, lineLens, ncols)
+
+    fields = chars.reshape(-1, width)
+    blank = numpy.all(fields == ord(' '), axis=1)
+    fields[blank] = numpy.frombuffer(b"nan".rjust(width), dtype=numpy.uint8)
+    return fields.view("S%d" % width).ravel().astype(numpy.float64)
+
+
+  def _pad(self, lineStarts, lineLens, ncols):
+    """
+    Get characters of lines padded with spaces (or truncated) to ncols.
+    """
+    cols = numpy.arange(ncols)
+    inside = cols < lineLens[:,None]
+    index = numpy.where(inside, lineStarts[:,None] + cols, 0)
+    return numpy.where(inside, self.raw[index], ord(' ')).astype(numpy.uint8)
+
 
 # ======================================================================
 # GNSCusp
@@ -19,9 +99,18 @@ class GNSCusp(object):
 
   # PUBLIC METHODS /////////////////////////////////////////////////////
 
-  def __init__(self, filename=None):
+  def __init__(self, filename=None, components=("acc", "vel", "disp"), headerOnly=False, cache=None):
     """
     Constructor.
+
+    :param components: Names of data blocks ("acc", "vel", "disp") to
+    read. Blocks not listed (or not in the file) are skipped and set to None.
+    :param headerOnly: If True, read only the header of the first
+    component (no data, azimuths of other components, or time).
+    :param cache: Directory for binary cache of parsed files. Data blocks
+    are loaded from the cache (binary .npy files) if the size
+    and modification time of the file match the cached entry; otherwise
+    the file is parsed and the cache entry is updated.
     """
     self._headerTotalLines = 16 + 4 + 6
     self._headerAlphaLines = 16
@@ -34,20 +123,42 @@ class GNSCusp(object):
     self.acc = None
     self.vel = None
     self.disp = None
+    self.time = None
 
     # Read the file.
     if self.filename is None:
       raise ValueError("Name of GNSCusp file has not been set.")
 
-    fin = open(self.filename, 'r')
-    lines = fin.readlines()
-    fin.close()
-    for component in xrange(3):
+    if headerOnly:
+      with open(self.filename, 'r') as fin:
+        lines = [fin.readline() for i in range(self._headerTotalLines)]
+      self._parseHeader(lines, 0)
+      return
+
+    if cache is not None and self._loadCache(cache, components):
+      self._setTime()
+      return
+
+    lines = _MappedLines(self.filename)
+    self._parseHeader(lines, 0)
+    self._setLayout(len(lines))
+    for component in range(1, 3):
       self._parseHeader(lines, component)
+    self._readData(lines, components)
     del lines
+    self._setTime()
 
-    self._readData()
+    if cache is not None:
+      self._saveCache(cache, components)
+    return
+
+
+  # PRIVATE METHODS ////////////////////////////////////////////////////
 
+  def _setTime(self):
+    """
+    Set time relative to origin time for data samples.
+    """
     relTime = self.header['start_time'] - self.header['origin_time']
     if relTime.days < 0:
         relTime = self.header['origin_time'] - self.header['start_time']
@@ -55,15 +166,14 @@ class GNSCusp(object):
     else:
       startTime = relTime.seconds + relTime.microseconds/1e+6
 
-    (nsamples, ncomps) = self.acc.shape
+    loaded = [data for data in (self.acc, self.vel, self.disp) if data is not None]
+    (ncomps, nsamples) = loaded[0].shape if loaded else (3, self.header['nsamples'])
     dt = self.header['dt']
     self.time = numpy.linspace(startTime, startTime + (nsamples-1)*dt,
                                nsamples)
     return
 
 
-  # PRIVATE METHODS ////////////////////////////////////////////////////
-
   def _parseHeader(self, lines, component):
     """
     Read first header in file.
@@ -92,7 +202,7 @@ class GNSCusp(object):
                                               int(fields1[2]),
                                               int(fields1[3]),
                                               int(fields1[4]),
-                                              int(fields1[5])/10,
+                                              int(fields1[5])//10,
                                               int(int(fields1[5])%10*100000))
 
     # line 2
@@ -113,7 +223,7 @@ class GNSCusp(object):
                                                int(fields2[8]),
                                                int(fields2[9]),
                                                int(fields4[8]),
-                                               int(fields4[9])/1000,
+                                               int(fields4[9])//1000,
                                                int(int(fields4[9])%1000)*1000)
     else:
       header['start_time']= header['origin_time']
@@ -146,60 +256,31 @@ class GNSCusp(object):
     #print self.azimuth
 
     if component == 0:
-      self._dataNumLines = header['nsamples'] / 10
-      if header['nsamples'] % 10 > 0: self._dataNumLines += 1
-      totalDataLines = len(lines) - 3*self._headerTotalLines
-      self._dataNumValues = totalDataLines / (3*self._dataNumLines)
       self.header = header
     return
 
 
-  def _readData(self):
+  def _setLayout(self, numLines):
+    """
+    Set number of lines and values (acc, vel, disp) in data blocks
+    using header of first component and number of lines in file.
+    """
+    self._dataNumLines = self.header['nsamples'] // 10
+    if self.header['nsamples'] % 10 > 0: self._dataNumLines += 1
+    totalDataLines = numLines - 3*self._headerTotalLines
+    self._dataNumValues = totalDataLines // (3*self._dataNumLines)
+    return
+
+
+  def _readData(self, lines, components):
     """
     Read data from file.
+
+    Each data block is stored as a C-contiguous array with shape (3,
+    nsamples) holding the E, N, U components in rows, so a component
+    is a contiguous row view.
     """
-    raw = numpy.genfromtxt(self.filename, delimiter=[8]*10)
-
-    # component 0
-    dataStart = self._headerTotalLines
-    acc0 = self._extract(raw, dataStart, self._dataNumLines)
-    dataStart += self._dataNumLines
-    if self._dataNumValues == 3:
-      vel0 = self._extract(raw, dataStart, self._dataNumLines)
-      dataStart += self._dataNumLines
-      disp0 = self._extract(raw, dataStart, self._dataNumLines)
-      dataStart += self._dataNumLines
-
-    # component 1
-    dataStart = self._headerTotalLines + \
-        1*(self._headerTotalLines + self._dataNumValues*self._dataNumLines)
-    acc1 = self._extract(raw, dataStart, self._dataNumLines)
-    dataStart += self._dataNumLines
-    if self._dataNumValues == 3:
-      vel1 = self._extract(raw, dataStart, self._dataNumLines)
-      dataStart += self._dataNumLines
-      disp1 = self._extract(raw, dataStart, self._dataNumLines)
-      dataStart += self._dataNumLines
-
-    # component 2
-    dataStart = self._headerTotalLines + \
-        2*(self._headerTotalLines + self._dataNumValues*self._dataNumLines)
-    acc2 = self._extract(raw, dataStart, self._dataNumLines)
-    dataStart += self._dataNumLines
-    if self._dataNumValues == 3:
-      vel2 = self._extract(raw, dataStart, self._dataNumLines)
-      dataStart += self._dataNumLines
-      disp2 = self._extract(raw, dataStart, self._dataNumLines)
-      dataStart += self._dataNumLines
-
-    # Assemble components
-    self.acc = numpy.array( (acc0, acc1, acc2) ).transpose()
-    self.acc *= self.header['toSI']
-    if self._dataNumValues == 3:
-      self.vel = numpy.array( (vel0, vel1, vel2) ).transpose()
-      self.vel *= self.header['toSI']
-      self.disp = numpy.array( (disp0, disp1, disp2) ).transpose()
-      self.disp *= self.header['toSI']
+    names = ["acc", "vel", "disp"] if self._dataNumValues == 3 else ["acc"]
 
     # Rotate to E,N,U
     R = numpy.zeros((3, 3), dtype=numpy.float64)
@@ -209,35 +290,284 @@ class GNSCusp(object):
         R[i,:] = (math.sin(azR), math.cos(azR), 0.0)
       else:
         R[i,:] = (0.0, 0.0, 1.0)
-    self.acc = numpy.dot(self.acc, R)
-    if not self.vel is None:
-      self.vel = numpy.dot(self.vel, R)
-    if not self.disp is None:
-      self.disp = numpy.dot(self.disp, R)
+    R = R.transpose()
+
+    for iname,name in enumerate(names):
+      if not name in components:
+        continue
+      data = None
+      for component in range(3):
+        dataStart = self._headerTotalLines + \
+            component*(self._headerTotalLines + self._dataNumValues*self._dataNumLines) + \
+            iname*self._dataNumLines
+        values = self._extract(lines, dataStart, self._dataNumLines)
+        if data is None:
+          data = numpy.empty((3, values.shape[0]), dtype=numpy.float64)
+        data[component,:] = values
+      data *= self.header['toSI']
+      self._rotate(data, R)
+      setattr(self, name, data)
+
+    return
 
+
+  def _rotate(self, data, R, blockSize=65536):
+    """
+    Apply rotation to data with components in rows, in place. Work
+    space is limited to one block of columns.
+    """
+    nsamples = data.shape[1]
+    for i in range(0, nsamples, blockSize):
+      block = data[:,i:i+blockSize]
+      block[:] = numpy.dot(R, block)
     return
 
 
-  def _extract(self, raw, start, size):
-    values = raw[start:start+size,:]
-    okay = values < 999999.8    
+  def _extract(self, lines, start, size):
+    values = lines.values(start, size)
+    okay = values < 999999.8
     return values[okay]
 
 
+  def _cacheBase(self, cache):
+    """
+    Get base name of cache files for file.
+    """
+    path = os.path.abspath(self.filename)
+    key = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache, "%s-%s" % (os.path.basename(path), key))
+
+
+  def _cacheRecord(self, cache):
+    """
+    Get cache record for file if it matches size and modification time
+    of file, otherwise None.
+    """
+    filename = self._cacheBase(cache) + ".json"
+    if not os.path.exists(filename):
+      return None
+    with open(filename, "r") as fin:
+      record = json.load(fin)
+    stat = os.stat(self.filename)
+    if record['size'] != stat.st_size or record['mtime'] != stat.st_mtime or \
+          record.get('layout') != "rows":
+      return None
+    return record
+
+
+  def _loadCache(self, cache, components):
+    """
+    Load header and data blocks from cache. Returns False if the cache
+    entry is missing, stale, or lacks a requested data block.
+    """
+    record = self._cacheRecord(cache)
+    if record is None:
+      return False
+    names = [name for name in components if name in record['blocks']]
+    if not set(names).issubset(record['cached']):
+      return False
+
+    header = dict(record['header'])
+    for key in ('origin_time', 'start_time'):
+      header[key] = datetime.datetime.fromisoformat(header[key])
+    self.header = header
+    self.azimuth = dict(enumerate(record['azimuth']))
+    base = self._cacheBase(cache)
+    for name in names:
+      setattr(self, name, numpy.load("%s.%s.npy" % (base, name)))
+    return True
+
+
+  def _saveCache(self, cache, components):
+    """
+    Write header and data blocks to cache.
+    """
+    if not os.path.isdir(cache):
+      os.makedirs(cache)
+    stat = os.stat(self.filename)
+    record = self._cacheRecord(cache)
+    cached = set(record['cached']) if record else set()
+
+    base = self._cacheBase(cache)
+    for name in components:
+      data = getattr(self, name)
+      if data is None:
+        continue
+      tmpFilename = "%s.%s.npy.tmp" % (base, name)
+      with open(tmpFilename, "wb") as fout:
+        numpy.save(fout, data)
+      os.replace(tmpFilename, "%s.%s.npy" % (base, name))
+      cached.add(name)
+
+    header = dict(self.header)
+    for key in ('origin_time', 'start_time'):
+      header[key] = header[key].isoformat()
+    record = {'size': stat.st_size,
+              'mtime': stat.st_mtime,
+              'header': header,
+              'azimuth': [self.azimuth[component] for component in range(3)],
+              'blocks': ["acc", "vel", "disp"] if self._dataNumValues == 3 else ["acc"],
+              'cached': sorted(cached),
+              'layout': "rows",
+              }
+    tmpFilename = base + ".json.tmp"
+    with open(tmpFilename, "w") as fout:
+      json.dump(record, fout, indent=1, sort_keys=True)
+    os.replace(tmpFilename, base + ".json")
+    return
+
+
+# ======================================================================
+# CuspIndex
+class CuspIndex(object):
+  """
+  Index of GNS CUSP files built from their headers only.
+
+  Each entry holds the site id, coordinates, origin time, start time,
+  time step, and number of samples of a file, along with the file size
+  and modification time so rescans only read new or changed files. The
+  index is stored as a JSON file.
+  """
+
+  # PUBLIC METHODS /////////////////////////////////////////////////////
+
+  def __init__(self, filename=None):
+    """
+    Constructor.
+
+    :param filename: Name of file for index. Existing entries are read if the file exists.
+    """
+    self.filename = filename
+    self.entries = {}
+    if filename is not None and os.path.exists(filename):
+      with open(filename, "r") as fin:
+        self.entries = json.load(fin)
+    return
+
+
+  def scan(self, directory, pattern="*"):
+    """
+    Add files in directory matching pattern to index. Entries for files
+    in the directory matching pattern that no longer exist are removed;
+    entries for other files are kept.
+    """
+    logger = logging.getLogger(__name__)
+
+    filenames = sorted(glob.glob(os.path.join(directory, pattern)))
+    found = set(filenames)
+    (patternDir, patternName) = os.path.split(os.path.join(directory, pattern))
+    patternDir = os.path.normpath(patternDir)
+    for filename in list(self.entries.keys()):
+      if os.path.normpath(os.path.dirname(filename)) == patternDir and \
+            fnmatch.fnmatch(os.path.basename(filename), patternName) and \
+            not filename in found:
+        self.entries.pop(filename)
+
+    for filename in filenames:
+      stat = os.stat(filename)
+      entry = self.entries.get(filename)
+      if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        continue
+      try:
+        header = GNSCusp(filename, headerOnly=True).header
+      except (ValueError, IndexError) as err:
+        logger.warning("Skipping '%s': %s" % (filename, err))
+        continue
+      self.entries[filename] = {'id': header['id'],
+                                'longitude': header['longitude'],
+                                'latitude': header['latitude'],
+                                'origin_time': header['origin_time'].isoformat(),
+                                'start_time': header['start_time'].isoformat(),
+                                'dt': header['dt'],
+                                'nsamples': header['nsamples'],
+                                'size': stat.st_size,
+                                'mtime': stat.st_mtime,
+                                }
+    return
+
+
+  def save(self, filename=None):
+    """
+    Write index to file.
+    """
+    filename = filename or self.filename
+    if filename is None:
+      raise ValueError("Name of CUSP index file has not been set.")
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, "w") as fout:
+      json.dump(self.entries, fout, indent=1, sort_keys=True)
+    os.replace(tmpFilename, filename)
+    return
+
+
+  def query(self, starttime=None, endtime=None, region=None, origintime=None):
+    """
+    Get names of files with records overlapping the time window and with
+    sites within the region. Use tostream(filenames, "%s") to load them.
+
+    :param starttime: Start of time window (UTCDateTime or datetime).
+    :param endtime: End of time window (UTCDateTime or datetime).
+    :param region: Region as (min longitude, max longitude, min latitude, max latitude).
+    :param origintime: Only include records with this origin time.
+    """
+    if starttime is not None:
+      starttime = obspy.UTCDateTime(starttime)
+    if endtime is not None:
+      endtime = obspy.UTCDateTime(endtime)
+    if origintime is not None:
+      origintime = obspy.UTCDateTime(origintime)
+
+    filenames = []
+    for filename in sorted(self.entries.keys()):
+      entry = self.entries[filename]
+      if region is not None:
+        (lonMin, lonMax, latMin, latMax) = region
+        if not (lonMin <= entry['longitude'] <= lonMax and latMin <= entry['latitude'] <= latMax):
+          continue
+      if origintime is not None and obspy.UTCDateTime(entry['origin_time']) != origintime:
+        continue
+      recordStart = obspy.UTCDateTime(entry['start_time'])
+      recordEnd = recordStart + (entry['nsamples']-1)*entry['dt']
+      if endtime is not None and recordStart > endtime:
+        continue
+      if starttime is not None and recordEnd < starttime:
+        continue
+      filenames.append(filename)
+    return filenames
+
+
 #-----------------------------------------------------------------------
-def tostream(sites, filepattern, channelCode="HN", network="NZ"):
+def _readSite(filename, components, cache=None):
     """
-    Convert GNS Cusp files to obspy stream.
+    Read GNS Cusp file and return header and requested data blocks.
+    """
+    cusp = GNSCusp(filename, components, cache=cache)
+    return (cusp.header, dict((name, getattr(cusp, name)) for name in components))
+
+
+#-----------------------------------------------------------------------
+def tostream(sites, filepattern, channelCode="HN", network="NZ", components=("acc", "vel", "disp"), workers=None, cache=None):
     """
+    Convert GNS Cusp files to obspy stream.
 
-    tracesAcc = []
-    tracesDisp = []
-    tracesVel = []
-    for site in sites:
-        filename = filepattern % site
-        cusp = GNSCusp(filename)
+    :param components: Names of data blocks ("acc", "vel", "disp") to convert.
+    :param workers: Number of worker processes or concurrent.futures executor used to read files in parallel. Default is serial.
+    :param cache: Directory for binary cache of parsed files (see GNSCusp).
+    :returns: Tuple with one stream for each name in components. Files without a data block contribute no traces to its stream.
+    """
+    filenames = [filepattern % site for site in sites]
+    if workers:
+        import concurrent.futures
+        if isinstance(workers, concurrent.futures.Executor):
+            results = list(workers.map(_readSite, filenames, [components]*len(filenames), [cache]*len(filenames)))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_readSite, filenames, [components]*len(filenames), [cache]*len(filenames)))
+    else:
+        results = [_readSite(filename, components, cache) for filename in filenames]
 
-        header = cusp.header
+    traces = dict((name, []) for name in components)
+    for header,data in results:
         for ic,component in enumerate(["E","N","Z"]):
             channel = "%s%s" % (channelCode, component)
 
@@ -250,19 +580,12 @@ def tostream(sites, filepattern, channelCode="HN", network="NZ"):
                         'delta': header['dt'],
                     }
 
-            trace = obspy.core.Trace(data=cusp.acc[:,ic], header=metadata)
-            tracesAcc.append(trace)
-                
-            trace = obspy.core.Trace(data=cusp.vel[:,ic], header=metadata)
-            tracesVel.append(trace)
-                
-            trace = obspy.core.Trace(data=cusp.disp[:,ic], header=metadata)
-            tracesDisp.append(trace)
-                
-    streamAcc = obspy.core.Stream(traces=tracesAcc)
-    streamVel = obspy.core.Stream(traces=tracesVel)
-    streamDisp = obspy.core.Stream(traces=tracesDisp)
-    return streamAcc, streamVel, streamDisp
+            for name in components:
+                if data[name] is not None:
+                    trace = obspy.core.Trace(data=data[name][ic], header=metadata)
+                    traces[name].append(trace)
+
+    return tuple(obspy.core.Stream(traces=traces[name]) for name in components)
 
 
 # End of file
@@ -0,0 +1,168 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+#
+
+import collections
+import functools
+
+# ----------------------------------------------------------------------
+# LazyTraces
+class LazyTraces(object):
+    """
+    Sequence of traces whose waveforms are created only when a trace
+    is accessed.
+
+    Without a cache size, created traces are kept, so each waveform is
+    created at most once. With a cache size, the most recently accessed
+    traces are kept up to the given number of bytes of waveform data,
+    and evicted waveforms are created again on their next access.
+    Slices are LazyTraces, so they do not create any waveforms.
+
+    Resources used by the loaders (for example, open files) are
+    released by close(), or on leaving a with block.
+    """
+
+    def __init__(self, headers, loaders, cacheSize=None, closers=None):
+        """
+        Constructor.
+
+        :param headers: List of trace headers.
+        :param loaders: List of functions without arguments that return the waveform for each trace.
+        :param cacheSize: Maximum number of bytes of waveform data to keep (None for no limit).
+        :param closers: List of functions without arguments that release resources used by the loaders.
+        """
+        self.headers = headers
+        self.loaders = loaders
+        self.cacheSize = cacheSize
+        self.closers = closers or []
+        self._traces = collections.OrderedDict()
+        self._cacheBytes = 0
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+    def __len__(self):
+        return len(self.headers)
+
+
+    def __getitem__(self, index):
+        import obspy.core
+
+        if isinstance(index, slice):
+            return self._subset(range(*index.indices(len(self.headers))))
+        if index < 0:
+            index += len(self.headers)
+        if not 0 <= index < len(self.headers):
+            raise IndexError("Trace index out of range.")
+        if index in self._traces:
+            self._traces.move_to_end(index)
+            return self._traces[index]
+
+        data = self.loaders[index]()
+        trace = obspy.core.Trace(data=data, header=self.headers[index])
+        self._traces[index] = trace
+        if self.cacheSize is None:
+            self.loaders[index] = None
+        else:
+            self._cacheBytes += trace.data.nbytes
+            while self._cacheBytes > self.cacheSize and len(self._traces) > 1:
+                (evicted, evictedTrace) = self._traces.popitem(last=False)
+                self._cacheBytes -= evictedTrace.data.nbytes
+        return trace
+
+
+    def __iter__(self):
+        for index in range(len(self.headers)):
+            yield self[index]
+
+
+    def select(self, network=None, station=None, channel=None):
+        """
+        Get stream with traces matching network, station, and channel
+        codes. Only waveforms of matching traces are created.
+        """
+        import obspy.core
+
+        return obspy.core.Stream(traces=[self[index] for index in self._match(network, station, channel)])
+
+
+    def subset(self, network=None, station=None, channel=None):
+        """
+        Get LazyTraces with traces matching network, station, and
+        channel codes without creating any waveforms. The subset has its
+        own cache with the same size. It uses the resources of these
+        traces, so it cannot load waveforms after they are closed.
+        """
+        return self._subset(self._match(network, station, channel))
+
+
+    def stream(self):
+        """
+        Get stream with all traces.
+        """
+        import obspy.core
+        return obspy.core.Stream(traces=list(self))
+
+
+    def close(self):
+        """
+        Release resources used by loaders and drop cached traces that
+        would be loaded again. Without a cache size, created traces are
+        kept, since their loaders have been released. Traces already
+        returned remain valid.
+        """
+        for closer in self.closers:
+            closer()
+        self.closers = []
+        if self.cacheSize is not None:
+            self._traces.clear()
+            self._cacheBytes = 0
+        return
+
+
+    def _subset(self, indices):
+        """
+        Get LazyTraces with traces at indices without creating any
+        waveforms.
+        """
+        headers = []
+        loaders = []
+        for index in indices:
+            headers.append(self.headers[index])
+            loaders.append(self.loaders[index] or functools.partial(self._data, index))
+        return LazyTraces(headers, loaders, self.cacheSize)
+
+
+    def _match(self, network, station, channel):
+        """
+        Get indices of headers matching network, station, and channel codes.
+        """
+        indices = []
+        for index,header in enumerate(self.headers):
+            if network is not None and header['network'] != network:
+                continue
+            if station is not None and header['station'] != station:
+                continue
+            if channel is not None and header['channel'] != channel:
+                continue
+            indices.append(index)
+        return indices
+
+
+    def _data(self, index):
+        return self[index].data
+
+
+# End of file
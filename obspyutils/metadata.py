@@ -6,18 +6,84 @@
 # ======================================================================
 
 import math
+import numpy
 import obspy
 
+# ----------------------------------------------------------------------
+# InventoryIndex
+class InventoryIndex(object):
+    """
+    Lookup of stations and channels in an inventory by code, built in
+    one pass over the inventory.
+
+    Each code maps to the list of epochs of the station or channel in
+    the order they appear in the inventory. Lookups given a time return
+    the epoch containing that time, falling back to the first epoch if
+    none does.
+    """
+
+    def __init__(self, inventory):
+        """
+        Constructor.
+
+        :type inventory: obspy.core.inventory.Inventory
+        :param inventory: Station inventory.
+        """
+        self.stations = {}
+        self.channels = {}
+        for network in inventory.networks:
+            for station in network.stations:
+                key = "%s.%s" % (network.code, station.code)
+                self.stations.setdefault(key, []).append(station)
+                for channel in station.channels:
+                    key = "%s.%s.%s" % (network.code, station.code, channel.code)
+                    self.channels.setdefault(key, []).append(channel)
+        return
+
+
+    def station(self, network, station, time=None):
+        """
+        Get station with network and station codes, or None if not found.
+        """
+        return self._epoch(self.stations.get("%s.%s" % (network, station), []), time)
+
+
+    def channel(self, network, station, channel, location=None, time=None):
+        """
+        Get channel with network, station, and channel codes, or None
+        if not found. If location is None, channels at any location
+        match.
+        """
+        epochs = self.channels.get("%s.%s.%s" % (network, station, channel), [])
+        if location is not None:
+            epochs = [epoch for epoch in epochs if epoch.location_code == location]
+        return self._epoch(epochs, time)
+
+
+    def _epoch(self, epochs, time):
+        if len(epochs) == 0:
+            return None
+        if time is not None:
+            for epoch in epochs:
+                if (epoch.start_date is None or epoch.start_date <= time) and \
+                        (epoch.end_date is None or time <= epoch.end_date):
+                    return epoch
+        return epochs[0]
+
+
 #-----------------------------------------------------------------------
 def addLocation(inventory, stream):
     """
     Add longitude, latitude, and elevation to trace stats.
+
+    Inventory is an obspy Inventory or an InventoryIndex. Reuse an
+    InventoryIndex when processing several streams.
     """
+    index = inventory if isinstance(inventory, InventoryIndex) else InventoryIndex(inventory)
     for trace in stream.traces:
-        ist = inventory.select(network=trace.stats.network, station=trace.stats.station)
-        if len(ist.networks) == 0 or len(ist.networks[0].stations) == 0:
-            raise ValueError("Could not find station '%s.%s' in inventory." % trace.stats.network, trace.stats.station)
-        stmeta = ist.networks[0].stations[0]
+        stmeta = index.station(trace.stats.network, trace.stats.station, trace.stats.starttime)
+        if stmeta is None:
+            raise ValueError("Could not find station '%s.%s' in inventory." % (trace.stats.network, trace.stats.station))
         info = {'longitude': stmeta.longitude,
                 'latitude': stmeta.latitude,
                 'elevation': stmeta.elevation,
@@ -27,29 +93,52 @@ def addLocation(inventory, stream):
 
 
 #-----------------------------------------------------------------------
-def addAzimuthDist(stream, epicenter, projection):
+def addAzimuthDist(stream, epicenter, projection=None, geodesic=False, ellps="WGS84"):
     """
     Add azimith and distance to stream stats.
     Epicenter is given in (longitude, latitude) and projection is a pyproj projection.
     
     projection = pyproj.Proj(proj='utm', zone=params.utmZone, ellps='WGS84')
+
+    Each station location is projected once, with all stations
+    projected in a single call. If geodesic is True, distance and
+    azimuth are computed along the geodesic on the ellipsoid ellps
+    instead of in the projection, which is suitable for stations
+    spanning more than one UTM zone.
+
+    The back azimuth is the direction from the station to the
+    epicenter in [0, 360).
     """
-    # Project epicenter
-    epicenterXY = projection(epicenter[0], epicenter[1])
+    traces = stream.traces
+    if len(traces) == 0:
+        return
+    coords = numpy.array([(trace.stats.longitude, trace.stats.latitude) for trace in traces], dtype=numpy.float64)
+    (stations, inverse) = numpy.unique(coords, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
 
-    for trace in stream.traces:
+    if geodesic:
+        import pyproj
+        geod = pyproj.Geod(ellps=ellps)
+        nstations = stations.shape[0]
+        (azimuth, az21, epidist) = geod.inv(numpy.full(nstations, epicenter[0]), numpy.full(nstations, epicenter[1]), stations[:,0], stations[:,1])
+        backAzimuth = numpy.asarray(az21) % 360.0
+    else:
+        # Project epicenter
+        epicenterXY = projection(epicenter[0], epicenter[1])
+        (stX, stY) = projection(stations[:,0], stations[:,1])
+        dx = numpy.asarray(stX) - epicenterXY[0]
+        dy = numpy.asarray(stY) - epicenterXY[1]
+        epidist = (dx**2 + dy**2)**0.5
+        azimuth = numpy.arctan2(dx, dy)/math.pi*180.0
+        backAzimuth = (azimuth + 180.0) % 360.0
 
-        stXY = projection(trace.stats.longitude, trace.stats.latitude)
-        epidist = ((stXY[0]-epicenterXY[0])**2 + (stXY[1]-epicenterXY[1])**2)**0.5
-        azimuth = math.atan2(stXY[0]-epicenterXY[0], stXY[1]-epicenterXY[1])/math.pi*180.0
-        if azimuth > 0:
-            backazimuth = azimuth - 180.0
-        else:
-            backazimuth = azimuth + 180.0
-
-        info = {'azimuth': azimuth,
-                'back_azimuth': 180-azimuth,
-                'distance': epidist}
+    azimuth = numpy.asarray(azimuth).tolist()
+    backAzimuth = backAzimuth.tolist()
+    epidist = numpy.asarray(epidist).tolist()
+    for trace,ist in zip(traces, inverse):
+        info = {'azimuth': azimuth[ist],
+                'back_azimuth': backAzimuth[ist],
+                'distance': epidist[ist]}
         trace.stats.update(info)
     return
 
@@ -73,14 +162,14 @@ def missing(inventory, stream):
 
     import collections
 
-    print "Missing:",len(missing)
+    print("Missing:", len(missing))
     missingO = collections.OrderedDict(sorted(missing.items()))
     for key, station in missingO.items():
-        print key
+        print(key)
 
-    print "\n"
-    print "Found:",len(found)
+    print("\n")
+    print("Found:", len(found))
     foundO = collections.OrderedDict(sorted(found.items()))
     for key, station in foundO.items():
-        print key
+        print(key)
 
@@ -7,10 +7,399 @@
 # ======================================================================
 #
 
+import collections
+import functools
+import json
+import os
 import numpy
 import logging
 
-def denoise(stream, wavelet="coif4", remove_bg=True, zero_coarse_levels=1, zero_fine_levels=1, preevent_window=10.0, preevent_threshold_reduction=2.0, store_orig=False, store_noise=False):
+from obspyutils.lazy import LazyTraces
+
+MODE = "zero"
+
+# ----------------------------------------------------------------------
+def _denoiseCoefs(coefs, samplingRate, remove_bg, zero_coarse_levels, zero_fine_levels, preevent_window, preevent_threshold_reduction, labels, profiles=None, measureNoise=True):
+    """
+    Apply the two denoising steps to the wavelet coefficients of
+    several waveforms with the same number of points.
+
+    The coefficients of all levels are packed into one array (ntraces,
+    ncoefs), so statistics are computed across traces and levels at
+    once.
+
+    :param coefs: Wavelet coefficients from pywt.wavedec(data, axis=-1) with data (ntraces, npts).
+    :param labels: Channel labels used in log messages.
+    :param profiles: Noise profile ({level: (std, number of coefficients)}) or None for each waveform. Thresholds for the second step come from the profile instead of the pre-event window if it has all detail levels of the coefficients. A level covers the same frequency band in waveforms of any length with the same sampling rate, so the profile may have additional (coarser) levels.
+    :param measureNoise: If True, measure pre-event noise levels of all waveforms, including those with thresholds from a profile.
+    :returns: Tuple (packed signal coefficients, packed noise coefficients, number of coefficients in each level, pre-event noise levels). The noise levels are {level: (std, number of coefficients)} for each waveform with measured noise levels and None otherwise.
+    """
+    logger = logging.getLogger(__name__)
+    verbose = logger.isEnabledFor(logging.INFO)
+
+    sizes = numpy.array([coef.shape[-1] for coef in coefs])
+    offsets = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+    packed = numpy.concatenate(coefs, axis=-1)
+    packedNoise = numpy.zeros(packed.shape)
+    ntraces = packed.shape[0]
+    nlevels = len(coefs)-1
+    noiseLevels = [None]*ntraces
+
+    if remove_bg:
+        mean = numpy.add.reduceat(packed, offsets, axis=-1) / sizes
+        centered = packed - numpy.repeat(mean, sizes, axis=-1)
+        centered *= centered
+        var = numpy.add.reduceat(centered, offsets, axis=-1) / sizes
+        centered *= centered
+        kurt = numpy.add.reduceat(centered, offsets, axis=-1) / (sizes*var**2) - 3
+        del centered
+        threshold = (24.0 / (sizes*(1.0-0.9)))**0.5
+        if verbose:
+            for itrace in range(ntraces):
+                for ilevel in range(nlevels+1):
+                    logger.info("Channel %s: Step 1, kurt: %f, threshold: %f" % (labels[itrace], kurt[itrace,ilevel], threshold[ilevel],))
+        mask = numpy.repeat(numpy.abs(kurt) <= threshold, sizes, axis=-1)
+        packedNoise[mask] = packed[mask]
+        packed[mask] = 0.0
+
+    if preevent_window is not None and preevent_window > 0.0:
+        numPtsPre = preevent_window*samplingRate
+        levels = nlevels - numpy.arange(nlevels)
+        numCoefPre = numpy.minimum((numPtsPre / 2**levels).astype(int), sizes[1:])
+
+        std = numpy.zeros((ntraces, nlevels))
+        numCoef = numpy.tile(numCoefPre.astype(numpy.float64), (ntraces, 1))
+        cached = numpy.zeros(ntraces, dtype=bool)
+        for itrace,profile in enumerate(profiles or []):
+            if profile and all(level in profile for level in levels.tolist()):
+                std[itrace] = [profile[level][0] for level in levels]
+                numCoef[itrace] = [profile[level][1] for level in levels]
+                cached[itrace] = True
+
+        measure = ~cached | measureNoise
+        if numpy.any(measure):
+            # Gather pre-event coefficients of detail levels, padded with NaN.
+            index = numpy.arange(max(1, numCoefPre.max()))
+            valid = index < numCoefPre[:,None]
+            index = numpy.where(valid, offsets[1:,None] + index, 0)
+            coefPre = numpy.abs(packed[measure][:,index])
+            coefPre[:,~valid] = numpy.nan
+            median = numpy.nanmedian(coefPre, axis=-1)
+            del coefPre
+            stdPre = numpy.zeros((ntraces, nlevels))
+            stdPre[measure] = median / 0.6745
+            std[~cached] = stdPre[~cached]
+            for itrace in numpy.flatnonzero(measure):
+                noiseLevels[itrace] = dict((int(level), (float(stdPre[itrace,i]), int(numCoefPre[i]))) for i,level in enumerate(levels))
+
+        threshold = numpy.zeros((ntraces, nlevels+1))
+        threshold[:,1:] = std * (2.0*numpy.log(numCoef)) / preevent_threshold_reduction
+        if verbose:
+            for itrace in range(ntraces):
+                for i,level in enumerate(levels):
+                    logger.info("Channel %s: Step 2: threshold level: %d, : %f" % (labels[itrace], level, threshold[itrace,1+i],))
+
+        # Soft threshold
+        threshold = numpy.repeat(threshold, sizes, axis=-1)
+        threshold *= numpy.sign(packed)
+        mask = numpy.abs(packed) < numpy.abs(threshold)
+        packedNoise += numpy.where(mask, packed, threshold)
+        packed -= numpy.where(mask, packed, threshold)
+        del threshold, mask
+
+    numCoarse = numpy.sum(sizes[:1+zero_coarse_levels])
+    packedNoise[:,:numCoarse] += packed[:,:numCoarse]
+    packed[:,:numCoarse] = 0.0
+    if zero_fine_levels > 0:
+        numFine = numpy.sum(sizes[-zero_fine_levels:])
+        packedNoise[:,-numFine:] += packed[:,-numFine:]
+        packed[:,-numFine:] = 0.0
+
+    return (packed, packedNoise, sizes, noiseLevels)
+
+
+# ----------------------------------------------------------------------
+def _unpack(packed, sizes):
+    """
+    Split packed coefficients into list of coefficients for each level.
+    """
+    return numpy.split(packed, numpy.cumsum(sizes)[:-1], axis=-1)
+
+
+# ----------------------------------------------------------------------
+def _coefSizes(npts, wavelet):
+    """
+    Number of coefficients in each level of pywt.wavedec() for a
+    waveform with npts points.
+    """
+    import pywt
+
+    filterLen = pywt.Wavelet(wavelet).dec_len
+    sizes = [npts]
+    for i in range(pywt.dwt_max_level(npts, filterLen)):
+        sizes.append(pywt.dwt_coeff_len(sizes[-1], filterLen, MODE))
+    return sizes[-1:] + sizes[:0:-1]
+
+
+# ----------------------------------------------------------------------
+def _waverecPacked(packed, sizes, wavelet):
+    """
+    Reconstruct waveform from packed wavelet coefficients.
+    """
+    import pywt
+    return pywt.waverec(_unpack(packed, sizes), wavelet, mode=MODE)
+
+
+# ----------------------------------------------------------------------
+def _signalToNoise(packed, packedNoise):
+    """
+    Signal to noise ratio for each row of packed coefficients.
+    """
+    # if soft threshold
+    mask = numpy.abs(packed) > 0.0
+    count = numpy.sum(mask, axis=-1)
+    rmsSignal = numpy.sqrt(numpy.sum(numpy.where(mask, packed**2, 0.0), axis=-1) / count)
+    rmsNoise = numpy.sqrt(numpy.sum(numpy.where(mask, packedNoise**2, 0.0), axis=-1) / count)
+    # hard threshold
+    #rmsSignal = numpy.sqrt(numpy.mean(packed**2, axis=-1))
+    #rmsNoise = numpy.sqrt(numpy.mean(packedNoise**2, axis=-1))
+    return rmsSignal/rmsNoise
+
+
+# ----------------------------------------------------------------------
+def _denoiseGroups(datas, samplingRates, labels, wavelet, batch, noise, options, profiles=None):
+    """
+    Denoise list of waveforms. If batch is True, waveforms with the same
+    number of points and sampling rate are denoised together.
+
+    :param noise: Form of noise to return: None, "waveform", or "coefs" (packed wavelet coefficients).
+    :param profiles: Noise profile or None for each waveform (see _denoiseCoefs).
+    :returns: List of (denoised waveform, noise or None, S/N, pre-event noise levels) in the same order as datas.
+    """
+    import pywt
+
+    groups = collections.OrderedDict()
+    for i,data in enumerate(datas):
+        key = (data.shape[0], samplingRates[i]) if batch else i
+        if not key in groups:
+            groups[key] = []
+        groups[key].append(i)
+
+    results = [None]*len(datas)
+    for indices in groups.values():
+        data = numpy.array([datas[i] for i in indices], dtype=numpy.float64)
+        coefs = pywt.wavedec(data, wavelet, mode=MODE, axis=-1)
+        del data
+
+        groupProfiles = [profiles[i] for i in indices] if profiles else None
+        (packed, packedNoise, sizes, noiseLevels) = _denoiseCoefs(coefs, samplingRates[indices[0]], labels=[labels[i] for i in indices], profiles=groupProfiles, **options)
+        del coefs
+
+        denoised = pywt.waverec(_unpack(packed, sizes), wavelet, mode=MODE, axis=-1)
+        if noise == "waveform":
+            dataNoise = pywt.waverec(_unpack(packedNoise, sizes), wavelet, mode=MODE, axis=-1)
+        elif noise == "coefs":
+            dataNoise = packedNoise
+
+        # Signal to noise ratio
+        StoN = _signalToNoise(packed, packedNoise)
+        for j,i in enumerate(indices):
+            results[i] = (denoised[j], dataNoise[j] if noise else None, StoN[j], noiseLevels[j])
+    return results
+
+
+# ----------------------------------------------------------------------
+def _denoiseWorker(blockNames, specs, wavelet, batch, noise, options):
+    """
+    Denoise waveforms in shared memory.
+
+    Each entry in specs is (offset, npts, output offset, noise offset,
+    sampling rate, label, noise profile). Denoised waveforms are written to the output
+    block, which has room for npts+1 samples per waveform, and noise
+    to the noise block.
+
+    :returns: List of (number of samples in output, S/N, pre-event noise levels).
+    """
+    from multiprocessing import shared_memory
+
+    blocks = [shared_memory.SharedMemory(name=name) for name in blockNames]
+    buffers = datas = results = None
+    try:
+        buffers = [numpy.ndarray((block.size//8,), dtype=numpy.float64, buffer=block.buf) for block in blocks]
+        datas = [buffers[0][spec[0]:spec[0]+spec[1]] for spec in specs]
+        results = _denoiseGroups(datas, [spec[4] for spec in specs], [spec[5] for spec in specs], wavelet, batch, noise, options, [spec[6] for spec in specs])
+        info = []
+        for (offset,npts,outOffset,noiseOffset,rate,label,profile),(denoised,dataNoise,StoN,noiseLevels) in zip(specs, results):
+            size = denoised.shape[0]
+            buffers[1][outOffset:outOffset+size] = denoised
+            if noise:
+                buffers[2][noiseOffset:noiseOffset+dataNoise.shape[0]] = dataNoise
+            info.append((size, StoN, noiseLevels))
+    finally:
+        buffers = datas = results = None
+        for block in blocks:
+            block.close()
+    return info
+
+
+# ----------------------------------------------------------------------
+def _denoiseShared(datas, samplingRates, labels, wavelet, batch, noise, options, profiles, workers):
+    """
+    Denoise list of waveforms over a pool of processes with the
+    waveforms passed through shared memory.
+
+    :returns: List of (denoised waveform, noise or None, S/N, pre-event noise levels) in the same order as datas.
+    """
+    import concurrent.futures
+    import os
+    from multiprocessing import shared_memory
+
+    if len(datas) == 0:
+        return []
+    sizes = [data.shape[0] for data in datas]
+    offsets = numpy.concatenate(([0], numpy.cumsum(sizes))).astype(int)
+    outOffsets = offsets + numpy.arange(len(datas)+1)
+    if noise == "coefs":
+        noiseSizes = [sum(_coefSizes(size, wavelet)) for size in sizes]
+        noiseOffsets = numpy.concatenate(([0], numpy.cumsum(noiseSizes))).astype(int)
+    else:
+        noiseSizes = None
+        noiseOffsets = outOffsets
+    blocks = []
+    buffers = None
+    try:
+        blocks.append(shared_memory.SharedMemory(create=True, size=8*max(1, offsets[-1])))
+        blocks.append(shared_memory.SharedMemory(create=True, size=8*max(1, outOffsets[-1])))
+        if noise:
+            blocks.append(shared_memory.SharedMemory(create=True, size=8*max(1, noiseOffsets[-1])))
+        buffers = [numpy.ndarray((block.size//8,), dtype=numpy.float64, buffer=block.buf) for block in blocks]
+        for data,offset in zip(datas, offsets):
+            buffers[0][offset:offset+data.shape[0]] = data
+
+        if isinstance(workers, concurrent.futures.Executor):
+            executor = workers
+            numChunks = os.cpu_count() or 1
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            numChunks = workers
+        blockNames = [block.name for block in blocks]
+        chunks = [chunk for chunk in numpy.array_split(numpy.arange(len(datas)), min(numChunks, len(datas))) if len(chunk) > 0]
+        futures = []
+        for chunk in chunks:
+            specs = [(int(offsets[i]), sizes[i], int(outOffsets[i]), int(noiseOffsets[i]), samplingRates[i], labels[i], profiles[i] if profiles else None) for i in chunk]
+            futures.append(executor.submit(_denoiseWorker, blockNames, specs, wavelet, batch, noise, options))
+        try:
+            info = []
+            for future in futures:
+                info += future.result()
+        finally:
+            if not executor is workers:
+                executor.shutdown()
+
+        results = []
+        for i,(size,StoN,noiseLevels) in enumerate(info):
+            denoised = buffers[1][outOffsets[i]:outOffsets[i]+size].copy()
+            dataNoise = None
+            if noise:
+                noiseSize = noiseSizes[i] if noiseSizes else size
+                dataNoise = buffers[2][noiseOffsets[i]:noiseOffsets[i]+noiseSize].copy()
+            results.append((denoised, dataNoise, StoN, noiseLevels))
+    finally:
+        buffers = None
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return results
+
+
+# ----------------------------------------------------------------------
+# NoiseProfileStore
+class NoiseProfileStore(object):
+    """
+    On-disk store of noise levels in the wavelet coefficients for each
+    channel (network.station.channel), wavelet, and sampling rate,
+    accumulated over events. Used by denoise() for thresholds in the
+    second step.
+
+    Each profile holds, for each wavelet level, the number of events
+    and sums of the noise standard deviation and number of pre-event
+    coefficients. Levels measured in every event are added, including
+    events whose thresholds came from the profile (unless denoise() is
+    called with update_profiles=False), so the profile keeps converging
+    to the average noise level. A profile is used for any record whose
+    levels it covers. The store is a JSON file.
+    """
+
+    def __init__(self, filename=None, minEvents=3):
+        """
+        Constructor.
+
+        :type filename: str
+        :param filename: Name of file for store. Existing profiles are read if the file exists.
+        :type minEvents: int
+        :param minEvents: Minimum number of events for a level of a profile to be used.
+        """
+        self.filename = filename
+        self.minEvents = minEvents
+        self.profiles = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "r") as fin:
+                self.profiles = json.load(fin)
+        return
+
+
+    def get(self, label, wavelet, samplingRate):
+        """
+        Get noise profile for channel.
+
+        :returns: Dictionary {level: (mean std, mean number of
+        coefficients)} with levels that have at least minEvents events,
+        or None if there are none.
+        """
+        profile = self.profiles.get(self._key(label, wavelet, samplingRate))
+        if profile is None:
+            return None
+        levels = {}
+        for level,(numEvents,sumStd,sumCoefs) in profile.items():
+            if numEvents >= self.minEvents:
+                levels[int(level)] = (sumStd/numEvents, sumCoefs/float(numEvents))
+        return levels or None
+
+
+    def add(self, label, wavelet, samplingRate, levels):
+        """
+        Add noise levels {level: (std, number of coefficients)} for one
+        event to profile for channel.
+        """
+        profile = self.profiles.setdefault(self._key(label, wavelet, samplingRate), {})
+        for level,(std,numCoefs) in levels.items():
+            if not numpy.isfinite(std):
+                continue
+            (numEvents, sumStd, sumCoefs) = profile.get(str(level), (0, 0.0, 0))
+            profile[str(level)] = (numEvents+1, sumStd+std, sumCoefs+numCoefs)
+        return
+
+
+    def save(self, filename=None):
+        """
+        Write store to file.
+        """
+        filename = filename or self.filename
+        if filename is None:
+            raise ValueError("Name of noise profile file has not been set.")
+        tmpFilename = filename + ".tmp"
+        with open(tmpFilename, "w") as fout:
+            json.dump(self.profiles, fout)
+        os.replace(tmpFilename, filename)
+        return
+
+
+    def _key(self, label, wavelet, samplingRate):
+        return "%s/%s/%r" % (label, wavelet, float(samplingRate))
+
+
+# ----------------------------------------------------------------------
+def denoise(stream, wavelet="coif4", remove_bg=True, zero_coarse_levels=1, zero_fine_levels=1, preevent_window=10.0, preevent_threshold_reduction=2.0, store_orig=False, store_noise=False, batch=False, workers=None, lazy=False, noise_profiles=None, update_profiles=True):
     """Remove noise from waveforms using wavelets in a two-step
     process. In the first step, noise is identified via a Kurtosis
     analysis of the wavelet coefficients. In the second step, the
@@ -29,97 +418,178 @@ def denoise(stream, wavelet="coif4", remove_bg=True, zero_coarse_levels=1, zero_
     :param store_orig: Return a copy of the original waveforms.
     :type store_noise: bool
     :param store_noise: Return the noise waveforms removed.
+    :type batch: bool
+    :param batch: If True, decompose traces with the same number of points and time step together as a 2-D array.
+    :type workers: int or concurrent.futures.Executor
+    :param workers: Number of worker processes or executor used to denoise traces in parallel. Default is serial.
+    :type lazy: bool
+    :param lazy: If True, return original and noise waveforms as LazyTraces, which create a waveform only when its trace is accessed. The noise is held as wavelet coefficients until then.
+    :type noise_profiles: NoiseProfileStore
+    :param noise_profiles: Store of per-channel noise levels. Channels with a profile for the sampling rate covering their wavelet levels use its thresholds in the second step instead of the pre-event window. Pre-event noise levels of the channels are added to the store.
+    :type update_profiles: bool
+    :param update_profiles: If False, pre-event noise levels are not measured for channels with thresholds from a profile, and their profiles are not updated.
     :returns: Dictionary containing the denoised waveforms and, if
     requested, original waveforms and noise waveforms.
 
     """
-    MODE = "zero"
-    
     try:
         import pywt
     except ImportError:
         raise ImportError("_denoise() requires PyWavelets (pywt) Python module.")
+    import obspy.core
 
     logger = logging.getLogger(__name__)
 
     dataOut = {}
     if store_orig:
-        dataOut["orig"] = stream.copy()
-
-    tracesNoise = []    
-    for tr in stream:
-        channelLabel = "%s.%s.%s" % (tr.stats.network, tr.stats.station, tr.stats.channel)
-        coefsNoise = []
-
-        coefs = pywt.wavedec(tr.data, wavelet, mode=MODE)
-        
-        if remove_bg:
-            for coef in coefs:
-                numCoef = coef.shape[-1]
-                std = numpy.std(coef)
-                mean = numpy.mean(coef)
-                kurt = numpy.sum((coef-mean)**4) / (numCoef*std**4) - 3
-                threshold = (24.0 / (numCoef*(1.0-0.9)))**0.5
-                logger.info("Channel %s: Step 1, kurt: %f, threshold: %f" % (channelLabel, kurt, threshold,))
-                mask = numpy.abs(kurt) <= threshold
-                if mask:
-                    coefsNoise.append(coef.copy())
-                    coef *= 0.0
-                else:
-                    coefsNoise.append(0.0*coef)
-                
-                    
-        if preevent_window is not None and preevent_window > 0.0:
-            numPtsPre = preevent_window*tr.stats.sampling_rate
-            nlevels = len(coefs)-1
-            for i,coef in enumerate(coefs[1:]):
-                level = nlevels - i
-                numCoefTarget = int(numPtsPre / 2**level)
-                coefPre = coef[:numCoefTarget]
-                numCoefPre = coefPre.shape[-1]
-                median = numpy.median(numpy.abs(coefPre))
-                std = median / 0.6745
-                threshold = std * (2.0*numpy.log(numCoefPre)) / preevent_threshold_reduction
-                logger.info("Channel %s: Step 2: threshold level: %d, : %f" % (channelLabel, level, threshold,))
-                mask = numpy.abs(coef) < threshold
-                coefsNoise[1+i][mask] += coef[mask]
-                coefsNoise[1+i][~mask] += threshold*numpy.sign(coef[~mask]) # (use for soft mask)
-                coef[mask] *= 0.0
-                coef[~mask] -= threshold*numpy.sign(coef[~mask]) # (use for soft mask)
-
-        for ilevel in range(1+zero_coarse_levels):
-            coefsNoise[ilevel] += coefs[ilevel].copy()
-            coefs[ilevel] *= 0.0
-        for ilevel in range(zero_fine_levels):
-            index = -(1+ilevel)
-            coefsNoise[index] += coefs[index].copy()
-            coefs[index] *= 0.0
-                
-        tr.data = pywt.waverec(coefs, wavelet, mode=MODE)
-
-        if store_noise:
-            trNoise = tr.copy()
-            trNoise.data = pywt.waverec(coefsNoise, wavelet, mode=MODE)
-            tracesNoise.append(trNoise)
-                
-        # Signal to noise ratio
-        cArray,cSlices = pywt.coeffs_to_array(coefs)
-        cArrayN,cSlices = pywt.coeffs_to_array(coefsNoise)
-        # if soft threshold
-        mask = numpy.abs(cArray) > 0.0
-        rmsSignal = numpy.sqrt(numpy.mean(cArray[mask]**2))
-        rmsNoise = numpy.sqrt(numpy.mean(cArrayN[mask]**2))
-        # hard threshold
-        #rmsSignal = numpy.sqrt(numpy.mean(cArray**2))
-        #rmsNoise = numpy.sqrt(numpy.mean(cArrayN**2))
-        tr.StoN = rmsSignal/rmsNoise
-        logger.info("Channel %s: S/N: %.1f" % (channelLabel, tr.StoN,))
+        if lazy:
+            # Denoised waveforms replace the data arrays, so the
+            # original arrays can be held without copying them.
+            loaders = [functools.partial(numpy.asarray, tr.data) for tr in stream]
+            dataOut["orig"] = LazyTraces([tr.stats.copy() for tr in stream], loaders)
+        else:
+            dataOut["orig"] = stream.copy()
 
-    dataOut["data"] = stream
+    options = {'remove_bg': remove_bg,
+               'zero_coarse_levels': zero_coarse_levels,
+               'zero_fine_levels': zero_fine_levels,
+               'preevent_window': preevent_window,
+               'preevent_threshold_reduction': preevent_threshold_reduction,
+               'measureNoise': update_profiles,
+               }
+    datas = [tr.data for tr in stream]
+    samplingRates = [tr.stats.sampling_rate for tr in stream]
+    labels = ["%s.%s.%s" % (tr.stats.network, tr.stats.station, tr.stats.channel) for tr in stream]
+    noise = None
     if store_noise:
-        import obspy.core
+        noise = "coefs" if lazy else "waveform"
+    profiles = None
+    if noise_profiles is not None:
+        profiles = [noise_profiles.get(label, wavelet, samplingRate) for label,samplingRate in zip(labels, samplingRates)]
+    if workers:
+        results = _denoiseShared(datas, samplingRates, labels, wavelet, batch, noise, options, profiles, workers)
+    else:
+        results = _denoiseGroups(datas, samplingRates, labels, wavelet, batch, noise, options, profiles)
+
+    tracesNoise = []
+    headersNoise = []
+    loadersNoise = []
+    for tr,data,label,(denoised,dataNoise,StoN,noiseLevels) in zip(stream, datas, labels, results):
+        if noise_profiles is not None and noiseLevels:
+            noise_profiles.add(label, wavelet, tr.stats.sampling_rate, noiseLevels)
+        tr.data = denoised
+        tr.StoN = StoN
+        logger.info("Channel %s: S/N: %.1f" % (label, tr.StoN,))
+        if noise == "waveform":
+            tracesNoise.append(obspy.core.Trace(data=dataNoise, header=tr.stats))
+        elif noise == "coefs":
+            headersNoise.append(tr.stats.copy())
+            loadersNoise.append(functools.partial(_waverecPacked, dataNoise, _coefSizes(data.shape[0], wavelet), wavelet))
+    del datas
+
+    dataOut["data"] = stream
+    if noise == "waveform":
         dataOut["noise"] = obspy.core.Stream(traces=tracesNoise)
-    
-        
+    elif noise == "coefs":
+        dataOut["noise"] = LazyTraces(headersNoise, loadersNoise)
+
     return dataOut
-            
+
+
+# ----------------------------------------------------------------------
+def denoise_continuous(packets, samplingRate, wavelet="coif4", block=3600.0, overlap=60.0, remove_bg=True, zero_coarse_levels=1, zero_fine_levels=1, threshold_reduction=2.0, noise_blocks=10, label=""):
+    """Generator for denoising continuous data in overlapping blocks
+    with the same two-step process as denoise().
+
+    Each block is extended by the overlap on both sides and only the
+    interior is kept, so block boundaries are not affected by the
+    padding of the wavelet transform. The noise level of each wavelet
+    level is estimated from each block (median absolute coefficient)
+    and the thresholds in the second step use the median of the
+    estimates over the most recent blocks, so no pre-event window is
+    needed. Only the current block is held in memory and denoised
+    samples are returned as soon as each block is done.
+
+    :type packets: numpy.ndarray or iterable
+    :param packets: Waveform samples or iterable over consecutive arrays of samples.
+    :type samplingRate: float
+    :param samplingRate: Sampling rate of waveform.
+    :type block: float
+    :param block: Duration of samples returned for each block.
+    :type overlap: float
+    :param overlap: Duration of overlap on each side of block.
+    :type threshold_reduction: float
+    :param threshold_reduction: Factor to reduce threshold of noise level in second step.
+    :type noise_blocks: int
+    :param noise_blocks: Number of recent blocks used to estimate noise level.
+    :type label: str
+    :param label: Channel label used in log messages.
+    :returns: Iterator over consecutive arrays of denoised samples.
+    """
+    try:
+        import pywt
+    except ImportError:
+        raise ImportError("denoise_continuous() requires PyWavelets (pywt) Python module.")
+
+    blockN = max(1, int(block*samplingRate))
+    overlapN = max(0, int(overlap*samplingRate))
+    windowN = blockN + 2*overlapN
+    if isinstance(packets, numpy.ndarray):
+        data = packets
+        packets = (data[i:i+windowN] for i in range(0, data.shape[0], windowN))
+
+    history = collections.deque(maxlen=noise_blocks)
+
+    def _denoiseWindow(window, start):
+        coefs = pywt.wavedec(window[None,:], wavelet, mode=MODE, axis=-1)
+        nlevels = len(coefs)-1
+        std = {}
+        for i,coef in enumerate(coefs[1:]):
+            std[nlevels-i] = numpy.median(numpy.abs(coef)) / 0.6745
+        history.append(std)
+        profile = {}
+        for i,coef in enumerate(coefs[1:]):
+            level = nlevels-i
+            profile[level] = (numpy.median([h[level] for h in history if level in h]), coef.shape[-1])
+
+        (packed, packedNoise, sizes, noiseLevels) = _denoiseCoefs(coefs, samplingRate, remove_bg, zero_coarse_levels, zero_fine_levels, window.shape[0]/samplingRate, threshold_reduction, [label], [profile], measureNoise=False)
+        denoised = pywt.waverec(_unpack(packed, sizes), wavelet, mode=MODE, axis=-1)[0]
+        return denoised[start:window.shape[0]]
+
+    buf = numpy.zeros(0)
+    bufStart = 0 # index of first sample in buffer
+    emitted = 0 # index of next sample to return
+    pending = [] # packets received after buffer
+    pendingN = 0
+    for packet in packets:
+        packet = numpy.asarray(packet, dtype=numpy.float64)
+        pending.append(packet)
+        pendingN += packet.shape[0]
+        # Join packets only once a window is full.
+        if bufStart + buf.shape[0] + pendingN < max(0, emitted-overlapN) + windowN:
+            continue
+        buf = numpy.concatenate([buf] + pending)
+        pending = []
+        pendingN = 0
+        while True:
+            windowStart = max(0, emitted-overlapN)
+            if bufStart + buf.shape[0] < windowStart + windowN:
+                break
+            window = buf[windowStart-bufStart:windowStart-bufStart+windowN]
+            segment = _denoiseWindow(window, emitted-windowStart)[:windowN-overlapN-(emitted-windowStart)]
+            yield segment
+            emitted += segment.shape[0]
+            buf = buf[max(0, emitted-overlapN)-bufStart:]
+            bufStart = max(0, emitted-overlapN)
+
+    # Remaining samples use last (full length if possible) window.
+    buf = numpy.concatenate([buf] + pending)
+    bufEnd = bufStart + buf.shape[0]
+    if bufEnd > emitted:
+        windowStart = max(bufStart, bufEnd-windowN)
+        window = buf[windowStart-bufStart:]
+        yield _denoiseWindow(window, emitted-windowStart)
+    return
+
+
+# End of file
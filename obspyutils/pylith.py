@@ -5,13 +5,94 @@
 #
 # ======================================================================
 
+import functools
+
 import obspy
 import numpy
 
 #-----------------------------------------------------------------------
-def tostream(filename, originTime=None, projection=None, channelCode="HX", dataType='vel'):
+def _selectPoints(names, points, stations=None, network=None, region=None):
     """
-    Convert HDF5 waveform output from PyLith simulation to obspy stream.
+    Get sorted indices of points matching station selection.
+    """
+    mask = numpy.ones(len(names), dtype=bool)
+    if stations is not None:
+        stations = set(stations)
+        mask &= numpy.array([name in stations or name.split('.')[1] in stations for name in names], dtype=bool)
+    if network is not None:
+        mask &= numpy.array([name.split('.')[0] == network for name in names], dtype=bool)
+    if region is not None:
+        (lonMin, lonMax, latMin, latMax) = region
+        mask &= (points[:,0] >= lonMin) & (points[:,0] <= lonMax) & \
+            (points[:,1] >= latMin) & (points[:,1] <= latMax)
+    return numpy.nonzero(mask)[0]
+
+
+#-----------------------------------------------------------------------
+def _readColumns(dataset, indices, maxBlockSize=2**26):
+    """
+    Read points (second dimension) of dataset with indices into array
+    with shape (npoints, ncomps, nsteps).
+
+    Points are read as hyperslabs spanning runs of indices, merging runs
+    that share chunks, and time steps are read in blocks of whole chunks
+    so each chunk is read only once. Each block holds at most
+    maxBlockSize bytes unless a single chunk is larger; unchunked
+    datasets are treated as having chunks of one time step.
+    """
+    (nsteps, npts, ncomps) = dataset.shape
+    chunks = dataset.chunks or (1, 1, ncomps)
+
+    # Runs of indices [start, stop), merged if gap is within a chunk.
+    spans = []
+    for index in indices:
+        if spans and index - spans[-1][1] < chunks[1]:
+            spans[-1][1] = index + 1
+        else:
+            spans.append([index, index + 1])
+
+    out = numpy.empty((len(indices), ncomps, nsteps), dtype=dataset.dtype)
+    iout = 0
+    for (start, stop) in spans:
+        span = indices[iout:iout + numpy.searchsorted(indices[iout:], stop)] - start
+        stepBlock = max(1, maxBlockSize // max(1, (stop-start)*ncomps*dataset.dtype.itemsize) // chunks[0]) * chunks[0]
+        for t0 in range(0, nsteps, stepBlock):
+            t1 = min(nsteps, t0 + stepBlock)
+            block = dataset[t0:t1, start:stop, :]
+            out[iout:iout+len(span), :, t0:t1] = block[:, span, :].transpose(1, 2, 0)
+        iout += len(span)
+    return out
+
+
+#-----------------------------------------------------------------------
+def _readColumn(dataset, ipt, ic):
+    """
+    Read time history of one component at one point of dataset.
+    """
+    return dataset[:, ipt, ic]
+
+
+#-----------------------------------------------------------------------
+def _readTime(filename):
+    """
+    Read time steps of HDF5 waveform output from PyLith simulation.
+    """
+    import h5py
+
+    with h5py.File(filename, "r", driver='sec2') as h5:
+        t = h5['/time'][:].ravel()
+    return t
+
+
+#-----------------------------------------------------------------------
+def _readPartition(filename, dataType, projection=None, stations=None, network=None, region=None, readData=True):
+    """
+    Read time, selected stations, and (optionally) their data from
+    HDF5 waveform output from PyLith simulation.
+
+    :returns: Tuple of time, names ('NETWORK.STATION') of selected
+    stations, their coordinates, indices of their points in the file,
+    data (None if readData is False), and name of the dataset.
     """
     import h5py
 
@@ -25,44 +106,136 @@ def tostream(filename, originTime=None, projection=None, channelCode="HX", dataT
         field = 'acceleration'
     else:
         raise ValueError("Unknown data type '%s'." % dataType)
-    t = h5['/time']
-    stations = h5['stations']
-    data = h5['/vertex_fields/%s' % field][:]
-    h5.close()
+    t = h5['/time'][:].ravel()
+    names = [name.decode() if isinstance(name, bytes) else name for name in h5['stations'][:]]
 
     if projection:
         lon,lat = projection(points[:,0], points[:,1], inverse=True)
         points[:,0] = lon
         points[:,1] = lat
 
+    dataset = h5['/vertex_fields/%s' % field]
     npts, ndims = points.shape
-    
-    nsteps, npts2, ncomps = data.shape
+    nsteps, npts2, ncomps = dataset.shape
     assert(npts == npts2)
     assert(3 == ndims)
     assert(3 == ncomps)
 
+    indices = _selectPoints(names, points, stations, network, region)
+    data = _readColumns(dataset, indices) if readData else None
+    datasetName = dataset.name
+    h5.close()
+
+    return (t, [names[ipt] for ipt in indices], points[indices], indices, data, datasetName)
+
+
+#-----------------------------------------------------------------------
+def _metadata(name, point, channel, t, originTime):
+    """
+    Get trace metadata for station.
+    """
+    (network, station) = name.split('.')
     dt = t[1]-t[0] # Assume uniform time step
 
-    for ipt in xrange(npts):
+    metadata = {'network': network,
+                'station': station,
+                'channel': channel,
+                'longitude': point[0],
+                'latitude': point[1],
+                'starttime': originTime+t[0],
+                'delta': dt,
+                }
+    return metadata
+
+
+#-----------------------------------------------------------------------
+def tostream(filename, originTime=None, projection=None, channelCode="HX", dataType='vel', stations=None, network=None, region=None, lazy=False, cacheSize=2**28):
+    """
+    Convert HDF5 waveform output from PyLith simulation to obspy stream.
+
+    Only the data for the selected stations are read from the file.
+
+    :param stations: Names of stations ('STATION' or 'NETWORK.STATION') to include.
+    :param network: Network of stations to include.
+    :param region: Region of stations to include as (min longitude, max longitude, min latitude, max latitude).
+    :param lazy: If True, return obspyutils.lazy.LazyTraces with the metadata of all traces, reading the data of a trace from the file when it is accessed. The file stays open until the LazyTraces are closed.
+    :param cacheSize: Maximum number of bytes of trace data kept in memory in lazy mode.
+    """
+    (t, names, points, indices, data, datasetName) = \
+        _readPartition(filename, dataType, projection, stations, network, region, readData=not lazy)
+    if lazy:
+        import h5py
+        h5 = h5py.File(filename, "r", driver='sec2')
+        dataset = h5[datasetName]
+
+    traces = []
+    headers = []
+    loaders = []
+    for iout,ipt in enumerate(indices):
+        for ic,component in enumerate(["E","N","Z"]):
+            channel = "%s%s" % (channelCode, component)
+            metadata = _metadata(names[iout], points[iout], channel, t, originTime)
+
+            if lazy:
+                metadata['npts'] = t.shape[0]
+                headers.append(metadata)
+                loaders.append(functools.partial(_readColumn, dataset, ipt, ic))
+            else:
+                trace = obspy.core.Trace(data=data[iout,ic], header=metadata)
+                traces.append(trace)
+
+    if lazy:
+        from obspyutils.lazy import LazyTraces
+        return LazyTraces(headers, loaders, cacheSize, closers=[h5.close])
+    stream = obspy.core.Stream(traces=traces)
+    return stream
+
+
+#-----------------------------------------------------------------------
+def tostream_partitions(filenames, originTime=None, projection=None, channelCode="HX", dataType='vel', stations=None, network=None, region=None, workers=None):
+    """
+    Convert HDF5 waveform output from PyLith simulation split across
+    several files to a single obspy stream ordered by station.
+
+    Each file is read as in tostream. The time steps in all files must
+    match; they are checked before any data are read. Stations present
+    in more than one file are included once.
+
+    :param workers: Number of worker processes or concurrent.futures executor used to read files in parallel. Default is serial.
+    """
+    t = _readTime(filenames[0]) if len(filenames) > 0 else None
+    for filename in filenames[1:]:
+        tPartition = _readTime(filename)
+        if tPartition.shape != t.shape or not numpy.allclose(tPartition, t, rtol=1.0e-10, atol=0.0):
+            raise ValueError("Time steps in PyLith output '%s' do not match those in '%s'." % (filename, filenames[0]))
+
+    args = (dataType, projection, stations, network, region)
+    if workers:
+        import concurrent.futures
+        nfiles = len(filenames)
+        argsMap = [[arg]*nfiles for arg in args]
+        if isinstance(workers, concurrent.futures.Executor):
+            partitions = list(workers.map(_readPartition, filenames, *argsMap))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                partitions = list(executor.map(_readPartition, filenames, *argsMap))
+    else:
+        partitions = [_readPartition(filename, *args) for filename in filenames]
 
-        (network, station) = stations[ipt].split('.')
+    entries = {}
+    for (tPartition, names, points, indices, data, datasetName) in partitions:
+        for iout,name in enumerate(names):
+            if not name in entries:
+                entries[name] = (points[iout], data[iout])
 
+    traces = []
+    for name in sorted(entries.keys(), key=lambda name: name.split('.')):
+        (point, data) = entries[name]
         for ic,component in enumerate(["E","N","Z"]):
             channel = "%s%s" % (channelCode, component)
+            metadata = _metadata(name, point, channel, t, originTime)
+            traces.append(obspy.core.Trace(data=data[ic], header=metadata))
 
-            metadata = {'network': network,
-                        'station': station,
-                        'channel': channel,
-                        'longitude': points[ipt,0],
-                        'latitude': points[ipt,1],
-                        'starttime': originTime+t[0],
-                        'delta': dt,
-                        }
-
-            trace = obspy.core.Trace(data=data[:,ipt,ic], header=metadata)
-            traces.append(trace)
-                
     stream = obspy.core.Stream(traces=traces)
     return stream
 
@@ -21,17 +21,21 @@ def _newTrace(data, header, component):
 
 # ----------------------------------------------------------------------
 def toENZ(inventory, stream):
+    """
+    Rotate channels of each station to E, N, Z using channel azimuth
+    and dip. Inventory is an obspy Inventory or an
+    obspyutils.metadata.InventoryIndex.
+    """
+    from obspyutils.metadata import InventoryIndex
+    index = inventory if isinstance(inventory, InventoryIndex) else InventoryIndex(inventory)
 
-    from subset import streamByStation
+    from obspyutils.subset import streamByStation
     streamSt = streamByStation(stream)
 
     from math import sin,cos,pi
     
     tracesR = []
     for stkey,streamO in streamSt.items():
-        ncode, scode = tuple(stkey.split('.'))
-        station = inventory.select(network=ncode, station=scode).networks[0].stations[0]
-
         # Find min starttime and max end time
         tr0 = streamO.traces[0]
         start_min = tr0.stats.starttime
@@ -47,11 +51,13 @@ def toENZ(inventory, stream):
 
         fail = False
         for tr in streamO.traces:
-            cinventory = inventory.select(network=tr.stats.network, station=tr.stats.station, channel=tr.stats.channel)
-            channel = cinventory.networks[0].stations[0].channels[0]
+            channel = index.channel(tr.stats.network, tr.stats.station, tr.stats.channel, tr.stats.location, tr.stats.starttime) or \
+                index.channel(tr.stats.network, tr.stats.station, tr.stats.channel, time=tr.stats.starttime)
+            if channel is None:
+                raise ValueError("Could not find channel '%s' in inventory." % tr.id)
             trC = tr.copy().trim(starttime=start_min, endtime=end_max, pad=True, fill_value=0)
             if trC.data.shape[0] != npts:
-                print "Mismatch in shape for channels of station: %s" % stkey
+                print("Mismatch in shape for channels of station: %s" % stkey)
                 fail = True
                 break
             azR = channel.azimuth.real * pi/180.0
@@ -5,58 +5,214 @@
 #
 # ======================================================================
 
+import functools
+import os
+
 import obspy
 import numpy
 
 #-----------------------------------------------------------------------
-def tostream(filename="DATA/STATIONS_FILTERED", dataDir="OUTPUT_FILES", originTime=None, channelCode="HX", dataType='vel', hdur=0.0):
+def _readStations(filename):
     """
-    Collect ASCII waveform output from SPECFEM3D simulation and convert them to obspy stream.
+    Read SPECFEM3D stations file and return list of (station, network,
+    latitude, longitude, elevation).
     """
     fin = open(filename, "r")
     lines = fin.readlines()
     fin.close()
 
-    traces = []
+    stations = []
     for line in lines:
         fields = line.split()
         if len(fields) != 6:
-            raise IOError("Unrecognized format for stations file.\nLine: '%s'") % line
+            raise IOError("Unrecognized format for stations file.\nLine: '%s'" % line)
         
         station = fields[0].strip()
         network = fields[1].strip()
         latitude = float(fields[2])
         longitude = float(fields[3])
         elevation = float(fields[4])
+        stations.append((station, network, latitude, longitude, elevation))
+    return stations
 
-        if dataType[0:4] == "disp":
-            suffix = "semd"
-        elif dataType[0:3] == "vel":
-            suffix = "semv"
-        elif dataType[0:3] == "acc":
-            suffix = "sema"
-            
+
+#-----------------------------------------------------------------------
+def _suffix(dataType):
+    """
+    Get suffix of SPECFEM3D seismogram files for type of data.
+    """
+    if dataType[0:4] == "disp":
+        suffix = "semd"
+    elif dataType[0:3] == "vel":
+        suffix = "semv"
+    elif dataType[0:3] == "acc":
+        suffix = "sema"
+    else:
+        raise ValueError("Unknown data type '%s'. Expected 'disp', 'vel', or 'acc'." % dataType)
+    return suffix
+
+
+#-----------------------------------------------------------------------
+def _readAscii(filename):
+    """
+    Read two-column (time, value) ASCII SPECFEM3D seismogram.
+    """
+    raw = numpy.loadtxt(filename, dtype=numpy.float64, ndmin=2)
+    if raw.shape[1] != 2:
+        raise IOError("Expected two columns in SPECFEM3D seismogram '%s'." % filename)
+    return (raw[:,0], raw[:,1])
+
+
+#-----------------------------------------------------------------------
+def _binaryLayout(filename, dtype):
+    """
+    Get record type of binary (time, value) SPECFEM3D seismogram.
+
+    Samples are (time, value) pairs of the given floating point type,
+    written either as a raw stream or as Fortran unformatted sequential
+    records (one pair per record, with 4-byte record markers). Returns
+    record type and number of samples.
+    """
+    dtype = numpy.dtype(dtype)
+    recordSize = 2*dtype.itemsize
+    fileSize = os.path.getsize(filename)
+
+    markers = numpy.fromfile(filename, dtype=numpy.int32, count=1)
+    if fileSize % (recordSize+8) == 0 and markers.shape[0] == 1 and markers[0] == recordSize:
+        layout = numpy.dtype([('head', numpy.int32), ('t', dtype), ('value', dtype), ('tail', numpy.int32)])
+    elif fileSize % recordSize == 0:
+        layout = numpy.dtype([('t', dtype), ('value', dtype)])
+    else:
+        raise IOError("Size of binary SPECFEM3D seismogram '%s' does not match (time, value) pairs of type %s." % (filename, dtype.name))
+    return (layout, fileSize // layout.itemsize)
+
+
+#-----------------------------------------------------------------------
+def _readBinary(filename, dtype="float32"):
+    """
+    Read binary (time, value) SPECFEM3D seismogram.
+
+    The file is read into memory rather than memory mapped, so no file
+    descriptor is held once the seismogram has been read. Returns the
+    time and value fields, with the values in a contiguous array.
+    """
+    (layout, npts) = _binaryLayout(filename, dtype)
+    raw = numpy.fromfile(filename, dtype=layout)
+    return (raw['t'], numpy.ascontiguousarray(raw['value']))
+
+
+#-----------------------------------------------------------------------
+def _binaryHeader(filename, dtype):
+    """
+    Get first two times and number of samples of binary SPECFEM3D
+    seismogram without reading its values.
+    """
+    (layout, npts) = _binaryLayout(filename, dtype)
+    raw = numpy.fromfile(filename, dtype=layout, count=min(2, npts))
+    return (raw['t'], npts)
+
+
+#-----------------------------------------------------------------------
+def _binaryData(filename, dtype):
+    """
+    Get values of binary SPECFEM3D seismogram.
+    """
+    return _readBinary(filename, dtype)[1]
+
+
+#-----------------------------------------------------------------------
+def _waveformFilenames(stations, dataDir, channelCode, dataType, binary):
+    """
+    Get names of SPECFEM3D seismogram files for stations, with the E, N,
+    and Z components of each station in order.
+    """
+    suffix = _suffix(dataType)
+    if binary:
+        suffix += ".bin"
+    wfilenames = []
+    for (station, network, latitude, longitude, elevation) in stations:
+        for component in ["E","N","Z"]:
+            channel = "%s%s" % (channelCode, component)
+            wfilenames.append("%s/%s.%s.%s.%s" % \
+                              (dataDir, station, network, channel, suffix))
+    return wfilenames
+
+
+#-----------------------------------------------------------------------
+def tostream(filename="DATA/STATIONS_FILTERED", dataDir="OUTPUT_FILES", originTime=None, channelCode="HX", dataType='vel', hdur=0.0, workers=None, binary=False, dtype="float32", previous=None, lazy=False, cacheSize=2**28):
+    """
+    Collect ASCII or binary waveform output from SPECFEM3D simulation and convert them to obspy stream.
+
+    :param workers: Number of worker processes or concurrent.futures executor used to read ASCII files in parallel. Default is serial.
+    :param binary: If True, read binary seismograms (STATION.NETWORK.CHANNEL.SUFFIX.bin) instead of ASCII ones.
+    :param dtype: Floating point type of binary seismograms.
+    :param previous: Dictionary of traces from an earlier conversion, keyed by seismogram filename. These files are not read and their traces are used as is.
+    :param lazy: If True, return obspyutils.lazy.LazyTraces with the metadata of all traces, reading the data of a trace when it is accessed. Only the first two times of each seismogram are read up front. Requires binary seismograms.
+    :param cacheSize: Maximum number of bytes of trace data kept in lazy mode.
+    """
+    if lazy and not binary:
+        raise ValueError("Lazy SPECFEM3D streams require binary seismograms.")
+    stations = _readStations(filename)
+    wfilenames = _waveformFilenames(stations, dataDir, channelCode, dataType, binary)
+    previous = previous or {}
+    toRead = [wfilename for wfilename in wfilenames if not wfilename in previous]
+
+    if lazy:
+        # Number of samples in place of data.
+        raws = (_binaryHeader(wfilename, dtype) for wfilename in toRead)
+    elif binary:
+        raws = (_readBinary(wfilename, dtype) for wfilename in toRead)
+    elif workers:
+        import concurrent.futures
+        if isinstance(workers, concurrent.futures.Executor):
+            raws = list(workers.map(_readAscii, toRead))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                raws = list(executor.map(_readAscii, toRead, chunksize=16))
+    else:
+        raws = [_readAscii(wfilename) for wfilename in toRead]
+
+    traces = []
+    headers = []
+    loaders = []
+    raws = iter(raws)
+    wfilenames = iter(wfilenames)
+    for (station, network, latitude, longitude, elevation) in stations:
         for component in ["E","N","Z"]:
+            wfilename = next(wfilenames)
+            if wfilename in previous:
+                if lazy:
+                    headers.append(previous[wfilename].stats)
+                    loaders.append(functools.partial(numpy.asarray, previous[wfilename].data))
+                else:
+                    traces.append(previous[wfilename])
+                continue
+
             channel = "%s%s" % (channelCode, component)
-            wfilename = "%s/%s.%s.%s.%s" % \
-              (dataDir, station, network, channel, suffix)
-            raw = numpy.loadtxt(wfilename)
-            t = raw[:,0] + hdur
-            data = raw[:,1]
-            dt = t[1]-t[0]
+            (t, data) = next(raws)
+            t0 = float(t[0]) + hdur
+            dt = (float(t[1]) + hdur) - t0
 
             metadata = {'network': network,
                         'station': station,
                         'channel': channel,
                         'longitude': longitude,
                         'latitude': latitude,
-                        'starttime': originTime+t[0],
+                        'starttime': originTime+t0,
                         'delta': dt,
                         }
 
-            trace = obspy.core.Trace(data=data, header=metadata)
-            traces.append(trace)
+            if lazy:
+                metadata['npts'] = int(data)
+                headers.append(metadata)
+                loaders.append(functools.partial(_binaryData, wfilename, dtype))
+            else:
+                trace = obspy.core.Trace(data=data, header=metadata)
+                traces.append(trace)
                 
+    if lazy:
+        from obspyutils.lazy import LazyTraces
+        return LazyTraces(headers, loaders, cacheSize)
     stream = obspy.core.Stream(traces=traces)
     return stream
 
@@ -82,26 +238,101 @@ class ToObspyApp(object):
         self.channelCode = None
         self.dataType = None
         self.dataDir = None
+
+        self.incremental = False
+        self.filenameManifest = None
         return
 
 
     def run(self):
         """
         Run conversion application.
+
+        In incremental mode, a manifest (default: output filename +
+        '.manifest') records the size and modification time of each
+        converted seismogram file. Traces for files that have not
+        changed since the previous run are taken from the previous
+        output instead of being converted again.
         """
-        import obspyutils.pickle as pickle
-        import obspyutils.metadata as metadata
+        import obspyutils.store as store
 
-        s = tostream(self.filenameIn, self.dataDir, self.originTime, self.channelCode, self.dataType)
+        settings = {'originTime': str(self.originTime),
+                    'channelCode': self.channelCode,
+                    'dataType': self.dataType,
+                    'dataDir': self.dataDir,
+                    }
+        previous = self._previousTraces(settings) if self.incremental else {}
+
+        s = tostream(self.filenameIn, self.dataDir, self.originTime, self.channelCode, self.dataType, previous=previous)
 
         # Add azimuth and distance
         if self.epicenter and self.utmZone:
             import pyproj
+            import obspyutils.metadata as metadata
             projection = pyproj.Proj(proj='utm', zone=self.utmZone, ellps='WGS84')
             metadata.addAzimuthDist(s, self.epicenter, projection)
             
-        pickle.pickle(self.filenameOut, s)
+        store.write(self.filenameOut, s)
+
+        if self.incremental:
+            self._writeManifest(settings, s)
+        return
+
+
+    def _manifestFilename(self):
+        """
+        Get name of manifest file.
+        """
+        return self.filenameManifest or self.filenameOut + ".manifest"
+
+
+    def _previousTraces(self, settings):
+        """
+        Get traces from previous output for seismogram files that are
+        unchanged since they were converted.
+        """
+        import json
+        import obspyutils.store as store
+
+        filename = self._manifestFilename()
+        if not os.path.exists(filename) or not os.path.exists(self.filenameOut):
+            return {}
+        with open(filename, "r") as fin:
+            manifest = json.load(fin)
+        if manifest['settings'] != settings:
+            return {}
+        stream = store.read(self.filenameOut)
+        tracesById = dict((trace.id, trace) for trace in stream)
+
+        previous = {}
+        for wfilename,entry in manifest['files'].items():
+            if not os.path.exists(wfilename) or not entry['trace'] in tracesById:
+                continue
+            stat = os.stat(wfilename)
+            if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                previous[wfilename] = tracesById[entry['trace']]
+        return previous
+
+
+    def _writeManifest(self, settings, stream):
+        """
+        Write manifest of converted seismogram files.
+        """
+        import json
 
+        stations = _readStations(self.filenameIn)
+        wfilenames = _waveformFilenames(stations, self.dataDir, self.channelCode, self.dataType, False)
+        files = {}
+        for wfilename,trace in zip(wfilenames, stream):
+            stat = os.stat(wfilename)
+            files[wfilename] = {'size': stat.st_size,
+                                'mtime': stat.st_mtime,
+                                'trace': trace.id,
+                                }
+        filename = self._manifestFilename()
+        with open(filename + ".tmp", "w") as fout:
+            json.dump({'settings': settings, 'files': files}, fout, indent=1, sort_keys=True)
+        os.replace(filename + ".tmp", filename)
         return
   
 #-----------------------------------------------------------------------
@@ -0,0 +1,183 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+#
+# Binary container for obspy streams with random access to traces.
+#
+# Layout:
+#   magic (8 bytes), header size (uint64, little endian), header,
+#   padding, data blocks.
+#
+# The header is a UTF-8 JSON object whose 'traces' list has one entry
+# per trace holding the trace id, stats, data type, number of samples,
+# and offset of the data block relative to the start of the data
+# blocks. Stats are stored as plain JSON values, with UTCDateTime
+# values as {"__UTCDateTime__": ISO 8601 string}. Data blocks are
+# aligned so they can be used directly from a memory map.
+
+import collections.abc
+import json
+import os
+import fnmatch
+
+import numpy
+import obspy
+
+MAGIC = b"OBSPYSTR"
+ALIGNMENT = 64
+
+
+# ----------------------------------------------------------------------
+def _align(offset):
+    """
+    Round offset up to alignment of data blocks.
+    """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+# ----------------------------------------------------------------------
+def _encode(value, name):
+    """
+    Convert value in trace stats to plain JSON values.
+    """
+    if isinstance(value, obspy.UTCDateTime):
+        return {'__UTCDateTime__': str(value)}
+    if isinstance(value, collections.abc.Mapping):
+        return dict((str(key), _encode(item, "%s.%s" % (name, key))) for key,item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_encode(item, name) for item in value]
+    if isinstance(value, (numpy.ndarray, numpy.generic)):
+        return _encode(value.tolist(), name)
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    raise TypeError("Cannot store stats entry '%s' of type %s." % (name, type(value).__name__))
+
+
+# ----------------------------------------------------------------------
+def _decode(value):
+    """
+    Convert UTCDateTime values in JSON object from header.
+    """
+    if len(value) == 1 and '__UTCDateTime__' in value:
+        return obspy.UTCDateTime(value['__UTCDateTime__'])
+    return value
+
+
+# ----------------------------------------------------------------------
+def write(filename, stream):
+    """
+    Write stream to file.
+
+    :type filename: str
+    :param filename: Name of file.
+    :type stream: obspy.core.Stream
+    :param stream: Stream to write. Masked arrays are not supported.
+        Stats may hold strings, numbers, booleans, None, UTCDateTime,
+        and lists, dictionaries, or numpy arrays of these.
+    """
+    header = []
+    datas = []
+    offset = 0
+    for trace in stream:
+        if isinstance(trace.data, numpy.ma.MaskedArray):
+            raise ValueError("Cannot store trace '%s' with masked data." % trace.id)
+        data = numpy.ascontiguousarray(trace.data)
+        header.append({'id': trace.id,
+                       'stats': _encode(trace.stats, trace.id),
+                       'dtype': data.dtype.str,
+                       'npts': data.shape[0],
+                       'offset': offset,
+                       })
+        datas.append(data)
+        offset = _align(offset + data.nbytes)
+    headerBytes = json.dumps({'traces': header}, sort_keys=True).encode("utf-8")
+    dataStart = _align(len(MAGIC) + 8 + len(headerBytes))
+
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, "wb") as fout:
+        fout.write(MAGIC)
+        fout.write(numpy.uint64(len(headerBytes)).astype("<u8").tobytes())
+        fout.write(headerBytes)
+        for entry,data in zip(header, datas):
+            fout.seek(dataStart + entry['offset'])
+            fout.write(data.tobytes())
+        fout.truncate(dataStart + offset)
+    os.replace(tmpFilename, filename)
+    return
+
+
+# ----------------------------------------------------------------------
+def read_index(filename):
+    """
+    Read header of file.
+
+    :type filename: str
+    :param filename: Name of file.
+    :returns: Tuple of offset of data blocks and list with one entry per
+        trace (dictionary with 'id', 'stats', 'dtype', 'npts', 'offset').
+        Stats are obspy.core.Stats.
+    """
+    with open(filename, "rb") as fin:
+        magic = fin.read(len(MAGIC))
+        if magic != MAGIC:
+            raise IOError("File '%s' is not an obspyutils stream file." % filename)
+        headerSize = int(numpy.frombuffer(fin.read(8), dtype="<u8")[0])
+        try:
+            header = json.loads(fin.read(headerSize).decode("utf-8"), object_hook=_decode)['traces']
+        except (ValueError, KeyError, TypeError):
+            raise IOError("Could not read header of stream file '%s'. Files with pickled headers are no longer supported." % filename)
+    for entry in header:
+        entry['stats'] = obspy.core.Stats(entry['stats'])
+    dataStart = _align(len(MAGIC) + 8 + headerSize)
+    return (dataStart, header)
+
+
+# ----------------------------------------------------------------------
+def read(filename, network="*", station="*", location="*", channel="*", mmap=True):
+    """
+    Read traces from file.
+
+    Traces are selected by matching their codes against Unix-style
+    wildcard patterns, as in obspy.core.Stream.select. Only the data
+    blocks of selected traces are accessed.
+
+    :type filename: str
+    :param filename: Name of file.
+    :type mmap: bool
+    :param mmap: If True, trace data are copy-on-write views of a memory
+        map of the file; otherwise the data blocks are read into memory.
+    :returns: obspy.core.Stream with selected traces.
+    """
+    (dataStart, header) = read_index(filename)
+
+    selected = []
+    for entry in header:
+        stats = entry['stats']
+        if fnmatch.fnmatch(stats.network.upper(), network.upper()) and \
+                fnmatch.fnmatch(stats.station.upper(), station.upper()) and \
+                fnmatch.fnmatch(stats.location.upper(), location.upper()) and \
+                fnmatch.fnmatch(stats.channel.upper(), channel.upper()):
+            selected.append(entry)
+
+    traces = []
+    if mmap and os.path.getsize(filename) > dataStart:
+        raw = numpy.memmap(filename, dtype=numpy.uint8, mode="c", offset=dataStart)
+        for entry in selected:
+            dtype = numpy.dtype(entry['dtype'])
+            data = raw[entry['offset']:entry['offset']+entry['npts']*dtype.itemsize].view(dtype)
+            traces.append(obspy.core.Trace(data=data, header=entry['stats']))
+    else:
+        with open(filename, "rb") as fin:
+            for entry in selected:
+                dtype = numpy.dtype(entry['dtype'])
+                data = numpy.empty(entry['npts'], dtype=dtype)
+                fin.seek(dataStart + entry['offset'])
+                fin.readinto(data)
+                traces.append(obspy.core.Trace(data=data, header=entry['stats']))
+    return obspy.core.Stream(traces=traces)
+
+
+# End of file
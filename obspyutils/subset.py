@@ -48,8 +48,8 @@ def pairsObsSyn(obs, syn):
     """
 
     if len(obs) != len(syn):
-        print "WARNING: Number of observed traces (%d) does not match number of synthetic traces (%d)." % \
-                         (len(obs), len(syn))
+        print("WARNING: Number of observed traces (%d) does not match number of synthetic traces (%d)." % \
+                         (len(obs), len(syn)))
     
     pairs = []
     for trObs in obs:
@@ -57,7 +57,7 @@ def pairsObsSyn(obs, syn):
         if 1 == len(trSyn):
             pairs.append((trObs, trSyn[0]))
         else:
-            print "WARNING: No synthetic found matching trace: %s" % trObs
+            print("WARNING: No synthetic found matching trace: %s" % trObs)
     return pairs
 
 
@@ -0,0 +1,354 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import concurrent.futures
+import math
+import unittest
+
+import numpy
+import obspy
+
+from obspyutils import baseline
+
+
+# ----------------------------------------------------------------------
+def _record(npts=6000, dt=0.01, seed=0, station="AAA", offset=1.234):
+    """
+    Synthetic acceleration record with a pre-event window, a strong
+    motion pulse, and a baseline offset after the pulse.
+    """
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(npts)*dt
+    data = 0.001*rng.standard_normal(npts) + 0.01
+    pulse = numpy.bitwise_and(t >= 20.0, t < 30.0)
+    data[pulse] += 0.5*numpy.sin(10.0*t[pulse])*numpy.exp(-(t[pulse]-20.0))
+    data += 0.002*(t > 20.0)
+    header = {'station': station, 'starttime': ORIGIN_TIME - 15.0 + offset, 'delta': dt}
+    return obspy.core.Trace(data=data, header=header)
+
+ORIGIN_TIME = obspy.UTCDateTime(2020, 1, 1, 0, 0, 15)
+
+
+# ----------------------------------------------------------------------
+class TestBaselineCorrectionV0(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = obspy.core.Stream([_record(seed=i, station="S%d" % i, offset=0.1*i) for i in range(4)])
+
+    def test_batch(self):
+        expected = self.stream.copy()
+        baseline.baseline_correction_v0(expected, ORIGIN_TIME, ttail=10.0)
+        for kwargs in ({'batch': True}, {'batch': True, 'workers': 2}):
+            stream = self.stream.copy()
+            baseline.baseline_correction_v0(stream, ORIGIN_TIME, ttail=10.0, **kwargs)
+            for trE,tr in zip(expected, stream):
+                numpy.testing.assert_allclose(tr.data, trE.data, rtol=0.0, atol=1.0e-10)
+
+
+# ----------------------------------------------------------------------
+class TestIncrementalV0(unittest.TestCase):
+
+    def test_replay(self):
+        trace = _record()
+        for npts in (2000, 3000, 4500, 6000):
+            expected = trace.copy()
+            expected.data = expected.data[:npts]
+            baseline.baseline_correction_v0(obspy.core.Stream([expected]), ORIGIN_TIME, ttail=10.0)
+
+            incremental = baseline.IncrementalV0(trace.stats, ORIGIN_TIME, ttail=10.0)
+            for i in range(0, npts, 37):
+                incremental.update(trace.data[i:min(i+37, npts)])
+            corrected = incremental.trace()
+            self.assertEqual(npts, corrected.stats.npts)
+            self.assertEqual(trace.stats.starttime, corrected.stats.starttime)
+            numpy.testing.assert_allclose(corrected.data, expected.data, rtol=0.0, atol=1.0e-9)
+
+    def test_corrected(self):
+        trace = _record()
+        raw = trace.data.copy()
+        incremental = baseline.IncrementalV0(trace.stats, ORIGIN_TIME, ttail=10.0)
+        for i in range(0, 4000, 250):
+            packet = trace.data[i:i+250]
+            incremental.update(packet)
+            expected = incremental.trace().data
+            corrected = incremental.corrected()
+            self.assertEqual(packet.shape[0], corrected.shape[0])
+            numpy.testing.assert_array_equal(expected[i:i+250], corrected)
+        numpy.testing.assert_array_equal(raw, trace.data)
+
+        # Ranges spanning packets.
+        for (start, end) in ((0, 4000), (100, 600), (250, 500), (3999, 5000), (10, 10)):
+            numpy.testing.assert_array_equal(expected[start:end], incremental.corrected(start, end))
+
+    def test_parameters(self):
+        trace = _record()
+        incremental = baseline.IncrementalV0(trace.stats, ORIGIN_TIME, ttail=10.0)
+        incremental.update(trace.data[:500])
+        (mean, v0, af, t1, t2) = incremental.parameters()
+        self.assertAlmostEqual(numpy.mean(trace.data[:500]), mean, places=12)
+
+
+# ----------------------------------------------------------------------
+class TestWorkers(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def setUp(self):
+        self.stream = obspy.core.Stream([_record(npts=3000+500*i, seed=i, station="S%d" % i, offset=0.1*i) for i in range(5)])
+
+    def _checkInPlace(self, func, *args):
+        expected = self.stream.copy()
+        func(expected, *args)
+        for workers in (2, self.executor):
+            stream = self.stream.copy()
+            func(stream, *args, workers=workers)
+            for trE,tr in zip(expected, stream):
+                numpy.testing.assert_allclose(tr.data, trE.data, rtol=0.0, atol=1.0e-12)
+
+    def test_corrections(self):
+        self._checkInPlace(baseline.baseline_correction_v0, ORIGIN_TIME, 10.0)
+        self._checkInPlace(baseline.baseline_correction_spline)
+        self._checkInPlace(baseline.baseline_correction_spline, 2.0, 10.0)
+        self._checkInPlace(baseline.correction_preonly)
+        self._checkInPlace(baseline.correction_constant)
+
+    def test_integrate(self):
+        for inplace in (False, True):
+            expected = self.stream.copy()
+            (velE, dispE) = baseline.integrate_acc(expected, inplace=inplace)
+            stream = self.stream.copy()
+            (vel, disp) = baseline.integrate_acc(stream, inplace=inplace, workers=self.executor)
+            for streamE,streamW in ((velE, vel), (dispE, disp), (expected, stream)):
+                self.assertEqual(len(streamE), len(streamW))
+                for trE,tr in zip(streamE, streamW):
+                    numpy.testing.assert_allclose(tr.data, trE.data, rtol=0.0, atol=1.0e-12)
+            if inplace:
+                self.assertIs(stream[0], vel[0])
+
+            expected = self.stream.copy()
+            dispE = baseline.integrate_vel(expected, inplace=inplace)
+            stream = self.stream.copy()
+            disp = baseline.integrate_vel(stream, inplace=inplace, workers=self.executor)
+            for streamE,streamW in ((dispE, disp), (expected, stream)):
+                for trE,tr in zip(streamE, streamW):
+                    numpy.testing.assert_allclose(tr.data, trE.data, rtol=0.0, atol=1.0e-12)
+            if inplace:
+                self.assertIs(stream[0], disp[0])
+
+    def test_empty(self):
+        stream = obspy.core.Stream()
+        baseline.baseline_correction_v0(stream, ORIGIN_TIME, workers=2)
+        baseline.correction_constant(stream, workers=2)
+        (vel, disp) = baseline.integrate_acc(stream, workers=2)
+        self.assertEqual(0, len(vel))
+        self.assertEqual(0, len(disp))
+        self.assertEqual(0, len(baseline.integrate_vel(stream, workers=2)))
+
+    def test_integer(self):
+        stream = obspy.core.Stream([obspy.core.Trace(data=numpy.arange(100, dtype=numpy.int32), header={'delta': 0.01})])
+        with self.assertRaises(TypeError):
+            baseline.correction_constant(stream, workers=self.executor)
+        with self.assertRaises(TypeError):
+            baseline.integrate_acc(stream, inplace=True, workers=self.executor)
+        numpy.testing.assert_array_equal(numpy.arange(100), stream[0].data)
+
+        # Outputs are floating point.
+        expected = baseline.integrate_vel(stream)
+        disp = baseline.integrate_vel(stream, workers=self.executor)
+        numpy.testing.assert_allclose(disp[0].data, expected[0].data, rtol=0.0, atol=1.0e-12)
+
+
+# ----------------------------------------------------------------------
+def _preonlyReference(data, dt, preevent_window=10.0):
+    """
+    Pre-event correction via polyfit of integrated pre-event window.
+    """
+    import scipy.integrate
+    numPreWindow = 1+int(preevent_window/dt)
+    t = numpy.arange(numPreWindow)*dt
+    poly = numpy.polyfit(t, scipy.integrate.cumulative_trapezoid(data[:numPreWindow], dx=dt, initial=0.0), deg=1)
+    return data - poly[0]
+
+
+# ----------------------------------------------------------------------
+def _constantReference(data, dt):
+    """
+    Constant correction via polyfit of doubly integrated record.
+    """
+    import scipy.integrate
+    t = numpy.arange(data.shape[0])*dt
+    vel = scipy.integrate.cumulative_trapezoid(data, dx=dt, initial=0.0)
+    disp = scipy.integrate.cumulative_trapezoid(vel, dx=dt, initial=0.0)
+    poly = numpy.polyfit(t, disp, deg=2)
+    return data - 2.0*poly[0]
+
+
+# ----------------------------------------------------------------------
+def _integrateReference(data, dt):
+    """
+    Integrate acceleration and velocity (integrated acceleration) with
+    cumulative_trapezoid and remove polynomial trends fit with polyfit.
+    """
+    import scipy.integrate
+    t = numpy.arange(data.shape[0])*dt
+    vel = scipy.integrate.cumulative_trapezoid(data, dx=dt, initial=0.0)
+    disp = scipy.integrate.cumulative_trapezoid(vel, dx=dt, initial=0.0)
+    poly = numpy.polyfit(t, disp, deg=2)
+    velAcc = vel - (2.0*poly[0]*t + poly[1])
+    dispAcc = disp - (poly[0]*t**2 + poly[1]*t + poly[2])
+
+    # Velocity is integrated acceleration.
+    poly = numpy.polyfit(t, disp, deg=1)
+    dispVel = disp - (2.0*poly[0]*t + poly[1]) - poly[0]
+    return (velAcc, dispAcc, dispVel)
+
+
+# ----------------------------------------------------------------------
+def _splineReference(data, dt, window):
+    """
+    Degree 5 least squares spline baseline of whole record.
+    """
+    import scipy.interpolate
+    t = numpy.arange(data.shape[0])*dt
+    knotsN = int(0.1*window/dt)
+    knots = numpy.linspace(t[knotsN//2], t[-knotsN//2], data.shape[0]//knotsN)
+    return scipy.interpolate.LSQUnivariateSpline(t, data, t=knots, k=5)(t)
+
+
+# ----------------------------------------------------------------------
+class TestOperators(unittest.TestCase):
+
+    def setUp(self):
+        self.traces = [_record(npts=npts, dt=dt, seed=i) for i,(npts, dt) in enumerate(((6000, 0.01), (3001, 0.02), (2500, 0.005)))]
+
+    def test_preonly(self):
+        for tr in self.traces:
+            expected = _preonlyReference(tr.data, tr.stats.delta)
+            corrected = tr.copy()
+            baseline.correction_preonly(corrected)
+            numpy.testing.assert_allclose(corrected.data, expected, rtol=0.0, atol=1.0e-13)
+
+            data = numpy.array([tr.data, 2.0*tr.data])
+            baseline.correction_preonly_array(data, tr.stats.delta)
+            numpy.testing.assert_allclose(data[1], 2.0*expected, rtol=0.0, atol=1.0e-13)
+
+    def test_constant(self):
+        for tr in self.traces:
+            expected = _constantReference(tr.data, tr.stats.delta)
+            corrected = tr.copy()
+            baseline.correction_constant(corrected)
+            numpy.testing.assert_allclose(corrected.data, expected, rtol=0.0, atol=1.0e-13)
+
+            data = numpy.array([tr.data, -tr.data])
+            baseline.correction_constant_array(data, tr.stats.delta)
+            numpy.testing.assert_allclose(data[1], -expected, rtol=0.0, atol=1.0e-13)
+
+    def test_operator(self):
+        # Operator applied to samples matches leading polyfit coefficient.
+        import scipy.integrate
+        rng = numpy.random.default_rng(1)
+        for (npts, dt, degree) in ((1001, 0.01, 1), (4000, 0.005, 2), (17, 0.1, 2)):
+            data = rng.standard_normal(npts)
+            integrated = data
+            for i in range(degree):
+                integrated = scipy.integrate.cumulative_trapezoid(integrated, dx=dt, initial=0.0)
+            poly = numpy.polyfit(numpy.arange(npts)*dt, integrated, deg=degree)
+            op = baseline._offsetOperator(npts, dt, degree)
+            self.assertAlmostEqual(poly[0]*math.factorial(degree), numpy.dot(data, op), places=10)
+
+    def test_integrate(self):
+        import scipy.integrate
+        for tr in self.traces:
+            (velE, dispE, dispVelE) = _integrateReference(tr.data, tr.stats.delta)
+            (vel, disp) = baseline.integrate_acc(tr)
+            numpy.testing.assert_allclose(vel.data, velE, rtol=0.0, atol=1.0e-12)
+            numpy.testing.assert_allclose(disp.data, dispE, rtol=0.0, atol=1.0e-12)
+
+            trVel = tr.copy()
+            trVel.data = scipy.integrate.cumulative_trapezoid(tr.data, dx=tr.stats.delta, initial=0.0)
+            disp = baseline.integrate_vel(trVel)
+            numpy.testing.assert_allclose(disp.data, dispVelE, rtol=0.0, atol=1.0e-12)
+
+
+# ----------------------------------------------------------------------
+class TestSplineBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.dt = 0.01
+        self.data = _record(npts=20000, dt=self.dt).data
+        self.data += 0.01*numpy.sin(0.05*numpy.arange(20000)*self.dt)
+
+    def _blocks(self, **kwargs):
+        segments = list(baseline.baseline_correction_spline_blocks(self.data, self.dt, **kwargs))
+        offsets = [i0 for i0,corrected in segments]
+        self.assertEqual(0, offsets[0])
+        for (i0, corrected),i1 in zip(segments, offsets[1:] + [self.data.shape[0]]):
+            self.assertEqual(i1-i0, corrected.shape[0])
+        return numpy.concatenate([corrected for i0,corrected in segments])
+
+    def test_single_block(self):
+        expected = self.data - _splineReference(self.data, self.dt, 2.0)
+        corrected = self._blocks(window=2.0, block=1000.0)
+        numpy.testing.assert_allclose(corrected, expected, rtol=0.0, atol=1.0e-10)
+
+        stream = obspy.core.Stream([obspy.core.Trace(self.data.copy(), header={'delta': self.dt})])
+        baseline.baseline_correction_spline(stream, window=2.0)
+        numpy.testing.assert_allclose(stream[0].data, expected, rtol=0.0, atol=1.0e-10)
+
+    def test_blend(self):
+        # Local baselines blended with linear tapers across overlaps.
+        (npts, blockN, overlapN) = (self.data.shape[0], 6000, 600)
+        step = blockN - overlapN
+        sumBaseline = numpy.zeros(npts)
+        sumWeight = numpy.zeros(npts)
+        start = 0
+        while True:
+            end = start + blockN
+            last = npts - end < blockN//2
+            if last:
+                end = npts
+            weight = numpy.ones(end-start)
+            taper = numpy.linspace(0.0, 1.0, overlapN+2)[1:-1]
+            if start > 0:
+                weight[:overlapN] = taper
+            if not last:
+                weight[-overlapN:] = taper[::-1]
+            sumBaseline[start:end] += weight*_splineReference(self.data[start:end], self.dt, 2.0)
+            sumWeight[start:end] += weight
+            if last:
+                break
+            start += step
+        expected = self.data - sumBaseline/sumWeight
+
+        data = self.data.copy()
+        corrected = self._blocks(window=2.0, block=blockN*self.dt, overlap=overlapN*self.dt)
+        numpy.testing.assert_array_equal(data, self.data)
+        numpy.testing.assert_allclose(corrected, expected, rtol=0.0, atol=1.0e-10)
+
+        stream = obspy.core.Stream([obspy.core.Trace(self.data.copy(), header={'delta': self.dt})])
+        baseline.baseline_correction_spline(stream, window=2.0, block=blockN*self.dt, overlap=overlapN*self.dt)
+        numpy.testing.assert_allclose(stream[0].data, expected, rtol=0.0, atol=1.0e-10)
+
+    def test_polynomial(self):
+        # Baseline of degree 5 polynomial is removed exactly.
+        t = numpy.arange(self.data.shape[0])*self.dt / 200.0
+        self.data = 0.3 - 0.2*t + 0.5*t**3 - 0.1*t**5
+        corrected = self._blocks(window=2.0, block=50.0, overlap=5.0)
+        numpy.testing.assert_allclose(corrected, 0.0, rtol=0.0, atol=1.0e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
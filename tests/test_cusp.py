@@ -0,0 +1,337 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import os
+import resource
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from obspyutils import cusp
+
+
+# ----------------------------------------------------------------------
+def _writeCusp(filename, site="ABCD", nsamples=123, seed=0, numValues=3, pad=None, newline="\n"):
+    """
+    Write GNS CUSP file with acceleration (and velocity and
+    displacement if numValues is 3) blocks for three components.
+
+    :param pad: Value used to fill the last line of each data block (None for a short line).
+    """
+    rng = numpy.random.default_rng(seed)
+    numLines = nsamples//10 + (1 if nsamples % 10 else 0)
+    azimuths = [30, 120, 500]
+    lines = []
+    for component in range(3):
+        lines += ["Strong motion record", "Site %s" % site, "Site name"]
+        lines += ["alpha header %d" % i for i in range(13)]
+        lines.append("2016 11 13 11 2 567 0 0 2016 11")
+        lines.append("0 0 0 0 0 0 0 0 13 11")
+        lines.append("0 0 0 0 0 0 0 %d 0 45" % azimuths[component])
+        lines.append("0 0 0 %d 0 0 0 0 3 4567" % nsamples)
+        lines.append("0 0 0 0 0 0 0 9.80665")
+        lines.append("41.2345 174.5670")
+        lines.append("%.3f 0 0 0 0 0.005" % (nsamples*0.005))
+        lines += ["0 0 0 0"]*3
+        for value in range(numValues):
+            values = ["%8.2f" % x for x in 100.0*rng.standard_normal(nsamples)]
+            if pad is not None:
+                values += ["%8.1f" % pad]*(10*numLines-nsamples)
+            lines += ["".join(values[10*i:10*i+10]) for i in range(numLines)]
+    with open(filename, "w", newline="") as fout:
+        fout.write(newline.join(lines) + newline)
+    return
+
+
+# ----------------------------------------------------------------------
+def _readReference(filename):
+    """
+    Read GNS CUSP file line by line with genfromtxt, as GNSCusp did
+    before the parser was vectorized. Returns header, azimuths, and
+    acc, vel, disp arrays with shape (nsamples, 3) (None if missing).
+    """
+    import datetime
+    import math
+
+    with open(filename, "r") as fin:
+        lines = fin.readlines()
+    headerLines = 26
+    nsamples = int(lines[19].split()[3])
+    numLines = nsamples//10 + (1 if nsamples % 10 else 0)
+    numValues = (len(lines) - 3*headerLines) // (3*numLines)
+    componentLines = headerLines + numValues*numLines
+
+    azimuths = {}
+    for component in range(3):
+        fields3 = lines[component*componentLines+18].split()
+        azimuths[component] = float(fields3[7])
+    fields1 = lines[16].split()
+    fields2 = lines[17].split()
+    fields3 = lines[18].split()
+    fields4 = lines[19].split()
+    origin = datetime.datetime(*[int(f) for f in fields1[:5]], int(fields1[5])//10, int(fields1[5])%10*100000)
+    start = datetime.datetime(int(fields1[8]), int(fields1[9]), int(fields2[8]), int(fields2[9]), int(fields4[8]), int(fields4[9])//1000, int(fields4[9])%1000*1000) if int(fields1[8]) != 0 else origin
+    header = {'id': lines[1].split()[1],
+              'name': lines[2].rstrip(),
+              'origin_time': origin,
+              'start_time': start,
+              'epicentral_dist': float(fields3[9]),
+              'nsamples': nsamples,
+              'toSI': float(lines[20].split()[7])*1.0e-3,
+              'longitude': float(lines[21].split()[1]),
+              'latitude': -float(lines[21].split()[0]),
+              'duration': float(lines[22].split()[0]),
+              'dt': float(lines[22].split()[5]),
+              }
+
+    raw = numpy.genfromtxt(filename, delimiter=[8]*10)
+    R = numpy.zeros((3, 3))
+    for i,az in azimuths.items():
+        R[i,:] = (math.sin(math.radians(az)), math.cos(math.radians(az)), 0.0) if az <= 360.0 else (0.0, 0.0, 1.0)
+    blocks = []
+    for ivalue in range(numValues):
+        components = []
+        for component in range(3):
+            start = headerLines + component*componentLines + ivalue*numLines
+            values = raw[start:start+numLines,:]
+            components.append(values[values < 999999.8])
+        blocks.append(numpy.dot(numpy.array(components).transpose()*header['toSI'], R))
+    blocks += [None]*(3-numValues)
+    return (header, azimuths, blocks[0], blocks[1], blocks[2])
+
+
+# ----------------------------------------------------------------------
+class TestGNSCusp(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "A.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _check(self, components=("acc", "vel", "disp")):
+        (header, azimuths, acc, vel, disp) = _readReference(self.filename)
+        record = cusp.GNSCusp(self.filename, components)
+        self.assertEqual(header, record.header)
+        self.assertEqual(azimuths, record.azimuth)
+        for name,expected in (("acc", acc), ("vel", vel), ("disp", disp)):
+            data = getattr(record, name)
+            if expected is None or not name in components:
+                self.assertIsNone(data)
+                continue
+            self.assertEqual((3, header['nsamples']), data.shape)
+            self.assertTrue(data.flags.c_contiguous)
+            numpy.testing.assert_allclose(data, expected.transpose(), rtol=1.0e-14, atol=1.0e-14)
+        self.assertEqual(header['nsamples'], record.time.shape[0])
+        return record
+
+    def test_full(self):
+        for nsamples in (120, 123, 1, 11):
+            _writeCusp(self.filename, nsamples=nsamples)
+            self._check()
+
+    def test_acc_only(self):
+        _writeCusp(self.filename, numValues=1)
+        record = self._check()
+        self.assertIsNone(record.vel)
+
+    def test_sentinel(self):
+        _writeCusp(self.filename, nsamples=127, pad=999999.9)
+        self._check()
+
+    def test_crlf(self):
+        _writeCusp(self.filename, nsamples=127, newline="\r\n")
+        self._check()
+
+    def test_components(self):
+        _writeCusp(self.filename)
+        self._check(("vel",))
+        self._check(("acc", "disp"))
+
+
+# ----------------------------------------------------------------------
+class TestToStream(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.sites = ["A", "B", "C"]
+        for i,site in enumerate(self.sites):
+            _writeCusp(os.path.join(self.dirname, "%s.txt" % site), site=site, seed=i)
+        self.filepattern = os.path.join(self.dirname, "%s.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_reference(self):
+        streams = cusp.tostream(self.sites, self.filepattern)
+        self.assertEqual(3, len(streams))
+        for isite,site in enumerate(self.sites):
+            (header, azimuths, acc, vel, disp) = _readReference(self.filepattern % site)
+            for stream,expected in zip(streams, (acc, vel, disp)):
+                for ic,component in enumerate("ENZ"):
+                    tr = stream[3*isite+ic]
+                    self.assertEqual("NZ.%s..HN%s" % (site, component), tr.id)
+                    self.assertEqual(header['dt'], tr.stats.delta)
+                    numpy.testing.assert_allclose(tr.data, expected[:,ic], rtol=1.0e-14, atol=1.0e-14)
+
+    def test_components_workers(self):
+        (acc, vel, disp) = cusp.tostream(self.sites, self.filepattern)
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            for workers in (2, executor):
+                streams = cusp.tostream(self.sites, self.filepattern, components=("disp", "acc"), workers=workers)
+                self.assertEqual(2, len(streams))
+                for streamE,stream in ((disp, streams[0]), (acc, streams[1])):
+                    self.assertEqual([tr.id for tr in streamE], [tr.id for tr in stream])
+                    for trE,tr in zip(streamE, stream):
+                        self.assertEqual(trE.stats, tr.stats)
+                        numpy.testing.assert_array_equal(trE.data, tr.data)
+
+
+# ----------------------------------------------------------------------
+class TestCuspIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        for i,site in enumerate(("A", "B", "C")):
+            _writeCusp(os.path.join(self.dirname, "%s.txt" % site), site=site, seed=i)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _names(self, index):
+        return sorted(os.path.basename(filename) for filename in index.entries)
+
+    def test_scan(self):
+        index = cusp.CuspIndex()
+        index.scan(self.dirname, "*.txt")
+        self.assertEqual(["A.txt", "B.txt", "C.txt"], self._names(index))
+
+        # Scanning with another pattern keeps entries not matching it.
+        index.scan(self.dirname, "A*")
+        self.assertEqual(["A.txt", "B.txt", "C.txt"], self._names(index))
+
+        # Entries for removed files matching pattern are dropped.
+        os.remove(os.path.join(self.dirname, "B.txt"))
+        index.scan(self.dirname, "A*")
+        self.assertEqual(["A.txt", "B.txt", "C.txt"], self._names(index))
+        index.scan(self.dirname, "*.txt")
+        self.assertEqual(["A.txt", "C.txt"], self._names(index))
+
+    def test_save_query(self):
+        filename = os.path.join(self.dirname, "index.json")
+        index = cusp.CuspIndex(filename)
+        index.scan(self.dirname, "*.txt")
+        index.save()
+
+        index = cusp.CuspIndex(filename)
+        self.assertEqual(3, len(index.query()))
+        self.assertEqual(3, len(index.query(region=(174.0, 175.0, -42.0, -41.0))))
+        self.assertEqual(0, len(index.query(region=(170.0, 171.0, -42.0, -41.0))))
+        self.assertEqual(0, len(index.query(starttime="2017-01-01")))
+
+        streams = cusp.tostream(index.query(), "%s", components=["acc"])
+        self.assertEqual(9, len(streams[0]))
+        record = cusp.GNSCusp(index.query()[0], components=["acc"])
+        self.assertEqual((3, 123), record.acc.shape)
+        self.assertTrue(record.acc.flags.c_contiguous)
+
+
+# ----------------------------------------------------------------------
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dirname, "cache")
+        self.filename = os.path.join(self.dirname, "A.txt")
+        _writeCusp(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _read(self, components):
+        with mock.patch.object(cusp, "_MappedLines", wraps=cusp._MappedLines) as parser:
+            record = cusp.GNSCusp(self.filename, components, cache=self.cache)
+        return (record, parser.call_count)
+
+    def _check(self, expected, record, components):
+        self.assertEqual(expected.header, record.header)
+        self.assertEqual(expected.azimuth, record.azimuth)
+        numpy.testing.assert_array_equal(expected.time, record.time)
+        for name in ("acc", "vel", "disp"):
+            if name in components:
+                numpy.testing.assert_array_equal(getattr(expected, name), getattr(record, name))
+            else:
+                self.assertIsNone(getattr(record, name))
+
+    def test_hit(self):
+        expected = cusp.GNSCusp(self.filename)
+        (record, parsed) = self._read(("acc", "vel", "disp"))
+        self.assertEqual(1, parsed)
+        (record, parsed) = self._read(("acc", "vel", "disp"))
+        self.assertEqual(0, parsed)
+        self._check(expected, record, ("acc", "vel", "disp"))
+        self.assertFalse(isinstance(record.acc, numpy.memmap))
+
+    def test_stale(self):
+        self._read(("acc",))
+        _writeCusp(self.filename, seed=4)
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        expected = cusp.GNSCusp(self.filename, ("acc",))
+
+        (record, parsed) = self._read(("acc",))
+        self.assertEqual(1, parsed)
+        self._check(expected, record, ("acc",))
+        (record, parsed) = self._read(("acc",))
+        self.assertEqual(0, parsed)
+        self._check(expected, record, ("acc",))
+
+    def test_components(self):
+        expected = cusp.GNSCusp(self.filename)
+        (record, parsed) = self._read(("acc",))
+        self.assertEqual(1, parsed)
+        self._check(expected, record, ("acc",))
+
+        # Block missing from cache is parsed and added to entry.
+        (record, parsed) = self._read(("vel",))
+        self.assertEqual(1, parsed)
+        self._check(expected, record, ("vel",))
+        (record, parsed) = self._read(("acc", "vel"))
+        self.assertEqual(0, parsed)
+        self._check(expected, record, ("acc", "vel"))
+        (record, parsed) = self._read(("disp",))
+        self.assertEqual(1, parsed)
+        self._check(expected, record, ("disp",))
+
+    def test_open_files(self):
+        sites = ["S%02d" % i for i in range(30)]
+        for i,site in enumerate(sites):
+            _writeCusp(os.path.join(self.dirname, "%s.txt" % site), site=site, nsamples=20, seed=i)
+        filepattern = os.path.join(self.dirname, "%s.txt")
+        expected = cusp.tostream(sites, filepattern, cache=self.cache)
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (64, limits[1]))
+            streams = cusp.tostream(sites, filepattern, cache=self.cache)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        for streamE,stream in zip(expected, streams):
+            self.assertEqual(90, len(stream))
+            for trE,tr in zip(streamE, stream):
+                numpy.testing.assert_array_equal(trE.data, tr.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
@@ -0,0 +1,87 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import unittest
+
+import numpy
+import obspy
+from obspy.core.inventory import Inventory, Network, Station, Channel
+
+from obspyutils import metadata
+from obspyutils import rotate
+
+
+# ----------------------------------------------------------------------
+def _channel(code, azimuth, dip, location="", start=None, end=None):
+    return Channel(code, location, 37.0, -122.0, 0.0, 0.0, azimuth=azimuth, dip=dip, start_date=start, end_date=end)
+
+
+# ----------------------------------------------------------------------
+class TestInventoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        T = obspy.UTCDateTime
+        channels = [_channel("HNE", 90.0, 0.0, start=T(2000,1,1), end=T(2010,1,1)),
+                    _channel("HNE", 95.0, 0.0, start=T(2010,1,1)),
+                    _channel("HNN", 0.0, 0.0),
+                    _channel("HNZ", 0.0, -90.0),
+                    _channel("HNE", 45.0, 0.0, location="10"),
+                    ]
+        stations = [Station("AAA", 37.0, -122.0, 10.0, channels=channels, start_date=T(2000,1,1), end_date=T(2010,1,1)),
+                    Station("AAA", 37.5, -122.5, 20.0, start_date=T(2010,1,1)),
+                    ]
+        self.inventory = Inventory([Network("BK", stations=stations)], "test")
+        self.index = metadata.InventoryIndex(self.inventory)
+
+    def _stream(self, starttime):
+        header = {'network': "BK", 'station': "AAA", 'starttime': starttime}
+        return obspy.core.Stream([obspy.core.Trace(numpy.ones(10), header=dict(header, channel=channel)) for channel in ("HNE", "HNN", "HNZ")])
+
+    def test_station(self):
+        T = obspy.UTCDateTime
+        self.assertEqual(37.0, self.index.station("BK", "AAA").latitude)
+        self.assertEqual(37.0, self.index.station("BK", "AAA", T(2005,1,1)).latitude)
+        self.assertEqual(37.5, self.index.station("BK", "AAA", T(2015,1,1)).latitude)
+        self.assertIsNone(self.index.station("BK", "ZZZ"))
+
+    def test_channel(self):
+        T = obspy.UTCDateTime
+        self.assertEqual(90.0, self.index.channel("BK", "AAA", "HNE").azimuth)
+        self.assertEqual(95.0, self.index.channel("BK", "AAA", "HNE", time=T(2012,1,1)).azimuth)
+        self.assertEqual(45.0, self.index.channel("BK", "AAA", "HNE", location="10").azimuth)
+        self.assertIsNone(self.index.channel("BK", "AAA", "HNE", location="20"))
+
+    def test_addLocation(self):
+        T = obspy.UTCDateTime
+        stream = self._stream(T(2005,1,1))
+        metadata.addLocation(self.inventory, stream)
+        self.assertEqual(37.0, stream[0].stats.latitude)
+
+        stream = self._stream(T(2012,1,1))
+        metadata.addLocation(self.index, stream)
+        self.assertEqual(37.5, stream[0].stats.latitude)
+
+        stream = obspy.core.Stream([obspy.core.Trace(header={'network': "XX", 'station': "QQQ"})])
+        with self.assertRaises(ValueError):
+            metadata.addLocation(self.index, stream)
+
+    def test_toENZ(self):
+        T = obspy.UTCDateTime
+        streamR = rotate.toENZ(self.inventory, self._stream(T(2005,1,1)))
+        self.assertEqual(["HNE", "HNN", "HNZ"], [tr.stats.channel for tr in streamR])
+        numpy.testing.assert_allclose([tr.data[0] for tr in streamR], [1.0, 1.0, 1.0], atol=1.0e-12)
+
+        streamR = rotate.toENZ(self.index, self._stream(T(2012,1,1)))
+        azR = numpy.radians(95.0)
+        numpy.testing.assert_allclose([tr.data[0] for tr in streamR], [numpy.sin(azR), numpy.cos(azR)+1.0, 1.0], atol=1.0e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
@@ -0,0 +1,91 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import functools
+import unittest
+
+import numpy
+import obspy
+
+from obspyutils import lazy
+
+
+# ----------------------------------------------------------------------
+class TestLazyTraces(unittest.TestCase):
+
+    def setUp(self):
+        self.headers = [{'network': "BK", 'station': "S%d" % i, 'channel': "HN"+component}
+                        for i in range(4) for component in "ENZ"]
+        self.datas = [numpy.full(10, float(i)) for i in range(len(self.headers))]
+        self.closed = []
+
+    def _traces(self, cacheSize=None):
+        loaders = [functools.partial(numpy.array, data) for data in self.datas]
+        return lazy.LazyTraces(self.headers, loaders, cacheSize, closers=[functools.partial(self.closed.append, True)])
+
+    def test_access(self):
+        traces = self._traces()
+        self.assertEqual(12, len(traces))
+        self.assertEqual(0, len(traces._traces))
+        numpy.testing.assert_array_equal(self.datas[4], traces[4].data)
+        numpy.testing.assert_array_equal(self.datas[11], traces[-1].data)
+        self.assertIs(traces[4], traces[4])
+        with self.assertRaises(IndexError):
+            traces[12]
+        self.assertEqual(12, len(list(traces)))
+
+    def test_slice(self):
+        traces = self._traces()
+        tail = traces[5:]
+        self.assertIsInstance(tail, lazy.LazyTraces)
+        self.assertEqual(7, len(tail))
+        self.assertEqual(0, len(traces._traces))
+        numpy.testing.assert_array_equal(self.datas[5], tail[0].data)
+        self.assertEqual([self.headers[i]['station'] for i in (1, 4, 7, 10)],
+                         [tr.stats.station for tr in traces[1::3]])
+        self.assertEqual(0, len(traces[20:]))
+
+    def test_cache(self):
+        traces = self._traces(cacheSize=2*80)
+        for tr in traces:
+            pass
+        self.assertEqual(2, len(traces._traces))
+        numpy.testing.assert_array_equal(self.datas[0], traces[0].data)
+
+    def test_close(self):
+        traces = self._traces()
+        trace = traces[2]
+        traces.close()
+        self.assertEqual([True], self.closed)
+
+        # Created traces are kept after close.
+        self.assertIs(trace, traces[2])
+        numpy.testing.assert_array_equal(self.datas[2], traces[2].data)
+
+        with self._traces(cacheSize=1000) as traces:
+            trace = traces[3]
+        self.assertEqual([True, True], self.closed)
+        numpy.testing.assert_array_equal(self.datas[3], trace.data)
+
+    def test_select(self):
+        traces = self._traces()
+        stream = traces.select(station="S1")
+        self.assertIsInstance(stream, obspy.core.Stream)
+        self.assertEqual(3, len(stream))
+        self.assertEqual(3, len(traces._traces))
+
+        subset = traces.subset(channel="HNZ")
+        self.assertEqual(4, len(subset))
+        self.assertEqual(3, len(traces._traces))
+        numpy.testing.assert_array_equal(self.datas[5], subset[1].data)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
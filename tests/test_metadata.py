@@ -0,0 +1,105 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import math
+import unittest
+
+import numpy
+import obspy
+
+from obspyutils import metadata
+
+
+# ----------------------------------------------------------------------
+def _azimuthDistLoop(stream, epicenter, projection):
+    """
+    Per-trace azimuth and distance in the projection.
+    """
+    epicenterXY = projection(epicenter[0], epicenter[1])
+    values = []
+    for trace in stream.traces:
+        stXY = projection(trace.stats.longitude, trace.stats.latitude)
+        epidist = ((stXY[0]-epicenterXY[0])**2 + (stXY[1]-epicenterXY[1])**2)**0.5
+        azimuth = math.atan2(stXY[0]-epicenterXY[0], stXY[1]-epicenterXY[1])/math.pi*180.0
+        values.append((azimuth, (azimuth+180.0) % 360.0, epidist))
+    return numpy.array(values)
+
+
+# ----------------------------------------------------------------------
+class TestAddAzimuthDist(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.default_rng(0)
+        traces = []
+        for i in range(50):
+            (lon, lat) = (-122.5 + rng.random(), 37.0 + rng.random())
+            for component in "ENZ":
+                trace = obspy.core.Trace(numpy.zeros(4), header={'station': "S%02d" % i, 'channel': "HN"+component})
+                trace.stats.longitude = lon
+                trace.stats.latitude = lat
+                traces.append(trace)
+        self.stream = obspy.core.Stream(traces=traces)
+        self.epicenter = (-121.9, 37.4)
+
+    def _values(self, stream):
+        return numpy.array([(tr.stats.azimuth, tr.stats.back_azimuth, tr.stats.distance) for tr in stream])
+
+    def test_utm(self):
+        import pyproj
+        projection = pyproj.Proj(proj='utm', zone=10, ellps='WGS84')
+        expected = _azimuthDistLoop(self.stream, self.epicenter, projection)
+        metadata.addAzimuthDist(self.stream, self.epicenter, projection)
+        numpy.testing.assert_allclose(self._values(self.stream), expected, rtol=1.0e-12, atol=1.0e-9)
+
+    def test_geodesic(self):
+        import pyproj
+        projection = pyproj.Proj(proj='utm', zone=10, ellps='WGS84')
+        expected = _azimuthDistLoop(self.stream, self.epicenter, projection)
+        metadata.addAzimuthDist(self.stream, self.epicenter, geodesic=True)
+        values = self._values(self.stream)
+
+        # Same as geodesic inverse for each trace.
+        geod = pyproj.Geod(ellps="WGS84")
+        for trace,(azimuth, backAzimuth, distance) in zip(self.stream, values):
+            (az12, az21, dist) = geod.inv(self.epicenter[0], self.epicenter[1], trace.stats.longitude, trace.stats.latitude)
+            self.assertAlmostEqual(azimuth, az12, places=9)
+            self.assertAlmostEqual(backAzimuth, az21 % 360.0, places=9)
+            self.assertAlmostEqual(distance, dist, places=6)
+
+        # Close to UTM values for stations near the epicenter.
+        dAzimuth = (values[:,0] - expected[:,0] + 180.0) % 360.0 - 180.0
+        self.assertLess(numpy.max(numpy.abs(dAzimuth)), 1.0)
+        numpy.testing.assert_allclose(values[:,2], expected[:,2], rtol=1.0e-3)
+
+    def test_back_azimuth(self):
+        import pyproj
+        projection = pyproj.Proj(proj='utm', zone=10, ellps='WGS84')
+        (x, y) = projection(*self.epicenter)
+        # Station 5 km from epicenter at azimuth 30 degrees.
+        stream = self.stream[:1]
+        (lon, lat) = projection(x+5.0e+3*math.sin(math.radians(30.0)), y+5.0e+3*math.cos(math.radians(30.0)), inverse=True)
+        stream[0].stats.longitude = lon
+        stream[0].stats.latitude = lat
+        metadata.addAzimuthDist(stream, self.epicenter, projection)
+        self.assertAlmostEqual(30.0, stream[0].stats.azimuth, places=6)
+        self.assertAlmostEqual(210.0, stream[0].stats.back_azimuth, places=6)
+
+        metadata.addAzimuthDist(stream, self.epicenter, geodesic=True)
+        self.assertTrue(0.0 <= stream[0].stats.back_azimuth < 360.0)
+        self.assertAlmostEqual(210.0, stream[0].stats.back_azimuth, delta=1.0)
+
+    def test_empty(self):
+        stream = obspy.core.Stream()
+        metadata.addAzimuthDist(stream, self.epicenter, geodesic=True)
+        self.assertEqual(0, len(stream))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
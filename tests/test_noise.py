@@ -0,0 +1,268 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+import obspy
+
+from obspyutils import noise
+
+
+# ----------------------------------------------------------------------
+def _stream(npts=4000, samplingRate=100.0, seed=0, numStations=2):
+    """
+    Synthetic records with noise and a pulse after a pre-event window.
+    """
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(npts) / samplingRate
+    traces = []
+    for i in range(numStations):
+        data = 0.01*rng.standard_normal(npts) + numpy.exp(-((t-25.0)/2.0)**2)*numpy.sin(5.0*t)
+        header = {'network': "BK", 'station': "S%d" % i, 'channel': "HNE", 'sampling_rate': samplingRate}
+        traces.append(obspy.core.Trace(data=data, header=header))
+    return obspy.core.Stream(traces=traces)
+
+
+# ----------------------------------------------------------------------
+def _denoiseReference(stream, wavelet="coif4", zero_coarse_levels=1, zero_fine_levels=1, preevent_window=10.0, preevent_threshold_reduction=2.0):
+    """
+    Denoise each trace level by level, as denoise() did before the
+    wavelet coefficients were packed. Returns denoised and noise
+    waveforms and S/N for each trace.
+    """
+    import pywt
+
+    results = []
+    for tr in stream:
+        coefs = pywt.wavedec(tr.data, wavelet, mode="zero")
+        coefsNoise = []
+        for coef in coefs:
+            numCoef = coef.shape[-1]
+            kurt = numpy.sum((coef-numpy.mean(coef))**4) / (numCoef*numpy.std(coef)**4) - 3
+            if numpy.abs(kurt) <= (24.0 / (numCoef*(1.0-0.9)))**0.5:
+                coefsNoise.append(coef.copy())
+                coef *= 0.0
+            else:
+                coefsNoise.append(0.0*coef)
+
+        numPtsPre = preevent_window*tr.stats.sampling_rate
+        nlevels = len(coefs)-1
+        for i,coef in enumerate(coefs[1:]):
+            coefPre = coef[:int(numPtsPre / 2**(nlevels-i))]
+            std = numpy.median(numpy.abs(coefPre)) / 0.6745
+            threshold = std * (2.0*numpy.log(coefPre.shape[-1])) / preevent_threshold_reduction
+            mask = numpy.abs(coef) < threshold
+            coefsNoise[1+i][mask] += coef[mask]
+            coefsNoise[1+i][~mask] += threshold*numpy.sign(coef[~mask])
+            coef[mask] *= 0.0
+            coef[~mask] -= threshold*numpy.sign(coef[~mask])
+
+        for ilevel in list(range(1+zero_coarse_levels)) + [-(1+ilevel) for ilevel in range(zero_fine_levels)]:
+            coefsNoise[ilevel] += coefs[ilevel]
+            coefs[ilevel] *= 0.0
+
+        (cArray, cSlices) = pywt.coeffs_to_array(coefs)
+        (cArrayN, cSlices) = pywt.coeffs_to_array(coefsNoise)
+        mask = numpy.abs(cArray) > 0.0
+        StoN = numpy.sqrt(numpy.mean(cArray[mask]**2)) / numpy.sqrt(numpy.mean(cArrayN[mask]**2))
+        results.append((pywt.waverec(coefs, wavelet, mode="zero"), pywt.waverec(coefsNoise, wavelet, mode="zero"), StoN))
+    return results
+
+
+# ----------------------------------------------------------------------
+class TestDenoise(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = _stream(numStations=3) + _stream(npts=3001, seed=1, numStations=2) + _stream(npts=4000, samplingRate=50.0, seed=2, numStations=2)
+
+    def test_reference(self):
+        expected = _denoiseReference(self.stream.copy())
+        for kwargs in ({}, {'batch': True}, {'lazy': True}, {'batch': True, 'lazy': True}):
+            stream = self.stream.copy()
+            out = noise.denoise(stream, store_orig=True, store_noise=True, **kwargs)
+            self.assertEqual(len(self.stream), len(out["noise"]))
+            for (denoised, dataNoise, StoN),tr,trNoise,trOrig,trE in zip(expected, stream, out["noise"], out["orig"], self.stream):
+                numpy.testing.assert_allclose(tr.data, denoised, rtol=0.0, atol=1.0e-12)
+                numpy.testing.assert_allclose(trNoise.data, dataNoise, rtol=0.0, atol=1.0e-12)
+                self.assertAlmostEqual(StoN, tr.StoN, places=9)
+                self.assertEqual(trE.stats, trOrig.stats)
+                numpy.testing.assert_array_equal(trE.data, trOrig.data)
+
+    def test_lazy(self):
+        expected = self.stream.copy()
+        outE = noise.denoise(expected, store_orig=True, store_noise=True)
+        stream = self.stream.copy()
+        out = noise.denoise(stream, store_orig=True, store_noise=True, lazy=True)
+        self.assertIsInstance(out["noise"], noise.LazyTraces)
+        self.assertIsInstance(out["orig"], noise.LazyTraces)
+        self.assertEqual(0, len(out["noise"]._traces))
+
+        # Only accessed traces are created.
+        trNoise = out["noise"][3]
+        self.assertEqual(1, len(out["noise"]._traces))
+        self.assertEqual(outE["noise"][3].stats, trNoise.stats)
+        numpy.testing.assert_array_equal(outE["noise"][3].data, trNoise.data)
+        for name in ("orig", "noise"):
+            for trE,tr in zip(outE[name], out[name]):
+                self.assertEqual(trE.stats, tr.stats)
+                numpy.testing.assert_array_equal(trE.data, tr.data)
+        for trE,tr in zip(expected, stream):
+            numpy.testing.assert_array_equal(trE.data, tr.data)
+
+
+# ----------------------------------------------------------------------
+class TestNoiseProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "profiles.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _numEvents(self, store, label="BK.S0.HNE", samplingRate=100.0):
+        profile = store.profiles[store._key(label, "coif4", samplingRate)]
+        return set(numEvents for (numEvents, sumStd, sumCoefs) in profile.values())
+
+    def test_accumulate(self):
+        store = noise.NoiseProfileStore(self.filename, minEvents=1)
+        for event in range(3):
+            noise.denoise(_stream(seed=event), noise_profiles=store)
+            self.assertEqual(set([event+1]), self._numEvents(store))
+        store.save()
+
+        store = noise.NoiseProfileStore(self.filename, minEvents=4)
+        self.assertIsNone(store.get("BK.S0.HNE", "coif4", 100.0))
+        noise.denoise(_stream(seed=3), noise_profiles=store)
+        self.assertEqual(set([4]), self._numEvents(store))
+        self.assertIsNotNone(store.get("BK.S0.HNE", "coif4", 100.0))
+
+    def test_profile_used(self):
+        store = noise.NoiseProfileStore(minEvents=1)
+        noise.denoise(_stream(seed=0), noise_profiles=store)
+
+        expected = _stream(seed=1)
+        noise.denoise(expected)
+        stream = _stream(seed=1)
+        noise.denoise(stream, noise_profiles=store)
+        self.assertFalse(numpy.allclose(expected[0].data, stream[0].data))
+
+    def test_mismatch(self):
+        store = noise.NoiseProfileStore(minEvents=1)
+        noise.denoise(_stream(npts=1000), noise_profiles=store)
+        self.assertIsNone(store.get("BK.S0.HNE", "coif4", 200.0))
+
+        # Profile for other sampling rate or without all wavelet levels is not used.
+        for (npts, samplingRate) in ((4000, 100.0), (1000, 200.0)):
+            expected = _stream(npts=npts, samplingRate=samplingRate, seed=1)
+            noise.denoise(expected)
+            stream = _stream(npts=npts, samplingRate=samplingRate, seed=1)
+            noise.denoise(stream, noise_profiles=store)
+            for trE,tr in zip(expected, stream):
+                numpy.testing.assert_array_equal(trE.data, tr.data)
+
+    def test_record_length(self):
+        # Profile from longer records covers levels of shorter ones.
+        store = noise.NoiseProfileStore(minEvents=1)
+        noise.denoise(_stream(npts=8000, seed=0), noise_profiles=store)
+        noise.denoise(_stream(npts=4000, seed=1), noise_profiles=store)
+        profile = store.get("BK.S0.HNE", "coif4", 100.0)
+        self.assertGreater(max(profile.keys()), len(noise._coefSizes(4000, "coif4"))-1)
+
+        expected = _stream(npts=4000, seed=2)
+        noise.denoise(expected)
+        stream = _stream(npts=4000, seed=2)
+        noise.denoise(stream, noise_profiles=store)
+        self.assertFalse(numpy.allclose(expected[0].data, stream[0].data))
+
+    def test_no_update(self):
+        store = noise.NoiseProfileStore(minEvents=1)
+        noise.denoise(_stream(seed=0), noise_profiles=store)
+        profiles = json.loads(json.dumps(store.profiles))
+
+        with mock.patch.object(numpy, "nanmedian", wraps=numpy.nanmedian) as median:
+            stream = _stream(seed=1)
+            noise.denoise(stream, noise_profiles=store, update_profiles=False)
+            self.assertEqual(0, median.call_count)
+        self.assertEqual(profiles, json.loads(json.dumps(store.profiles)))
+
+        # Same thresholds as when the profile is updated.
+        store.profiles = profiles
+        expectedUpdate = _stream(seed=1)
+        noise.denoise(expectedUpdate, noise_profiles=store)
+        for trE,tr in zip(expectedUpdate, stream):
+            numpy.testing.assert_array_equal(trE.data, tr.data)
+
+
+# ----------------------------------------------------------------------
+class TestDenoiseWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = _stream(numStations=3) + _stream(npts=3000, seed=1, numStations=2)
+
+    def test_workers(self):
+        expected = self.stream.copy()
+        outE = noise.denoise(expected, store_noise=True)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            for workers in (2, executor):
+                for kwargs in ({}, {'batch': True}, {'lazy': True}):
+                    stream = self.stream.copy()
+                    out = noise.denoise(stream, store_noise=True, workers=workers, **kwargs)
+                    for trE,tr,noiseE,noiseW in zip(expected, stream, outE["noise"], out["noise"]):
+                        numpy.testing.assert_allclose(tr.data, trE.data, rtol=0.0, atol=1.0e-12)
+                        numpy.testing.assert_allclose(noiseW.data, noiseE.data, rtol=0.0, atol=1.0e-12)
+                        self.assertAlmostEqual(trE.StoN, tr.StoN, places=9)
+
+    def test_empty(self):
+        out = noise.denoise(obspy.core.Stream(), store_orig=True, store_noise=True, workers=2)
+        self.assertEqual(0, len(out["data"]))
+        self.assertEqual(0, len(out["noise"]))
+
+
+# ----------------------------------------------------------------------
+class TestDenoiseContinuous(unittest.TestCase):
+
+    def setUp(self):
+        self.samplingRate = 20.0
+        self.data = _stream(npts=9001, samplingRate=self.samplingRate, numStations=1)[0].data
+        self.options = {'block': 60.0, 'overlap': 10.0}
+
+    def _denoise(self, packets):
+        segments = list(noise.denoise_continuous(packets, self.samplingRate, **self.options))
+        return numpy.concatenate(segments)
+
+    def test_length(self):
+        for npts in (9001, 1200, 1601, 50):
+            denoised = self._denoise(self.data[:npts])
+            self.assertEqual(npts, denoised.shape[0])
+
+    def test_packet_size(self):
+        expected = self._denoise(self.data)
+        self.assertEqual(self.data.shape[0], expected.shape[0])
+        for size in (1, 20, 333, 5000, 20000):
+            packets = (self.data[i:i+size] for i in range(0, self.data.shape[0], size))
+            numpy.testing.assert_array_equal(expected, self._denoise(packets))
+
+        # Irregular packets, including empty ones.
+        rng = numpy.random.default_rng(0)
+        bounds = numpy.concatenate(([0], numpy.sort(rng.integers(0, self.data.shape[0], 40)), [self.data.shape[0]]))
+        packets = [self.data[start:end] for start,end in zip(bounds[:-1], bounds[1:])]
+        numpy.testing.assert_array_equal(expected, self._denoise(packets))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
@@ -0,0 +1,202 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+import obspy
+
+from obspyutils import pylith
+
+ORIGIN_TIME = obspy.UTCDateTime(2020, 1, 1)
+
+
+# ----------------------------------------------------------------------
+def _writeOutput(filename, npts=40, nsteps=30, chunks=None, seed=0):
+    """
+    Write PyLith-style HDF5 station output and return velocity field.
+    """
+    import h5py
+
+    rng = numpy.random.default_rng(seed)
+    velocity = rng.standard_normal((nsteps, npts, 3))
+    with h5py.File(filename, "w") as h5:
+        h5['/geometry/vertices'] = numpy.column_stack((-122.0 + 0.01*numpy.arange(npts), 37.0 + 0.01*numpy.arange(npts), numpy.zeros(npts)))
+        h5['/time'] = (0.05*numpy.arange(nsteps)).reshape(-1, 1, 1)
+        h5['stations'] = numpy.array([("%s.S%03d" % ("BK" if i % 2 else "NC", i)).encode() for i in range(npts)])
+        h5.create_dataset('/vertex_fields/velocity', data=velocity, chunks=chunks)
+    return velocity
+
+
+# ----------------------------------------------------------------------
+class TestPyLith(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "output.h5")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _check(self, stream, velocity):
+        for trace in stream:
+            ipt = int(trace.stats.station[1:])
+            ic = "ENZ".index(trace.stats.channel[-1])
+            numpy.testing.assert_array_equal(velocity[:,ipt,ic], trace.data)
+            self.assertEqual(ORIGIN_TIME, trace.stats.starttime)
+            self.assertAlmostEqual(0.05, trace.stats.delta)
+
+    def test_select(self):
+        for chunks in (None, (10, 8, 3), (30, 1, 3)):
+            velocity = _writeOutput(self.filename, chunks=chunks)
+            for (kwargs, numStations) in (({}, 40),
+                                          ({'network': "BK"}, 20),
+                                          ({'stations': ["S003", "NC.S010", "BK.S011", "S039"]}, 4),
+                                          ({'region': (-121.95, -121.85, 36.0, 38.0)}, 11)):
+                stream = pylith.tostream(self.filename, ORIGIN_TIME, **kwargs)
+                self.assertEqual(3*numStations, len(stream))
+                self._check(stream, velocity)
+
+    def test_read_blocks(self):
+        import h5py
+
+        class Reads(object):
+            """Dataset wrapper recording shapes of reads."""
+            def __init__(self, dataset):
+                self.dataset = dataset
+                self.shape = dataset.shape
+                self.dtype = dataset.dtype
+                self.chunks = dataset.chunks
+                self.reads = []
+            def __getitem__(self, key):
+                block = self.dataset[key]
+                self.reads.append(block.shape)
+                return block
+
+        indices = numpy.array([0, 1, 2, 7, 20, 21, 39])
+        for chunks in (None, (10, 8, 3)):
+            velocity = _writeOutput(self.filename, chunks=chunks)
+            with h5py.File(self.filename, "r") as h5:
+                dataset = Reads(h5['/vertex_fields/velocity'])
+                maxBlockSize = 3*3*8*10
+                data = pylith._readColumns(dataset, indices, maxBlockSize=maxBlockSize)
+            numpy.testing.assert_array_equal(velocity[:,indices,:].transpose(1, 2, 0), data)
+            if chunks is None:
+                # Reads are bounded by block size.
+                for shape in dataset.reads:
+                    self.assertLessEqual(numpy.prod(shape)*8, maxBlockSize)
+            else:
+                # Reads span whole chunks in time.
+                for shape in dataset.reads:
+                    self.assertEqual(0, shape[0] % chunks[0])
+
+    def test_lazy_close(self):
+        velocity = _writeOutput(self.filename)
+        expected = pylith.tostream(self.filename, ORIGIN_TIME)
+        with pylith.tostream(self.filename, ORIGIN_TIME, lazy=True, cacheSize=1000) as traces:
+            self.assertEqual(len(expected), len(traces))
+            for trE,tr in zip(expected, traces):
+                self.assertEqual(trE.stats, tr.stats)
+                numpy.testing.assert_array_equal(trE.data, tr.data)
+            self.assertLessEqual(len(traces._traces), 5)
+
+        # File is no longer held open, so it can be rewritten.
+        velocity = _writeOutput(self.filename, seed=1)
+        traces = pylith.tostream(self.filename, ORIGIN_TIME, lazy=True)
+        self._check(traces.subset(station="S003").stream(), velocity)
+        traces.close()
+
+
+# ----------------------------------------------------------------------
+def _writePartition(filename, velocity, indices, dt=0.05):
+    """
+    Write PyLith-style HDF5 station output for stations at indices of
+    velocity field.
+    """
+    import h5py
+
+    indices = numpy.asarray(indices)
+    with h5py.File(filename, "w") as h5:
+        h5['/geometry/vertices'] = numpy.column_stack((-122.0 + 0.01*indices, 37.0 + 0.01*indices, numpy.zeros(indices.shape[0])))
+        h5['/time'] = (dt*numpy.arange(velocity.shape[0])).reshape(-1, 1, 1)
+        h5['stations'] = numpy.array([("%s.S%03d" % ("BK" if i % 2 else "NC", i)).encode() for i in indices])
+        h5['/vertex_fields/velocity'] = velocity[:,indices,:]
+    return
+
+
+# ----------------------------------------------------------------------
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.velocity = _writeOutput(os.path.join(self.dirname, "full.h5"))
+        self.filenames = []
+        for i,indices in enumerate((range(0, 40, 3), range(1, 40, 3), range(2, 40, 3))):
+            filename = os.path.join(self.dirname, "output_p%d.h5" % i)
+            _writePartition(filename, self.velocity, list(indices))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _expected(self, **kwargs):
+        stream = pylith.tostream(os.path.join(self.dirname, "full.h5"), ORIGIN_TIME, **kwargs)
+        order = sorted(range(len(stream)), key=lambda i: (stream[i].stats.network, stream[i].stats.station))
+        return [stream[i] for i in order]
+
+    def _checkStream(self, expected, stream):
+        self.assertEqual([tr.id for tr in expected], [tr.id for tr in stream])
+        for trE,tr in zip(expected, stream):
+            self.assertEqual(trE.stats, tr.stats)
+            numpy.testing.assert_array_equal(trE.data, tr.data)
+
+    def test_merge(self):
+        stream = pylith.tostream_partitions(self.filenames, ORIGIN_TIME)
+        self._checkStream(self._expected(), stream)
+        stream = pylith.tostream_partitions(self.filenames[::-1], ORIGIN_TIME, network="BK")
+        self._checkStream(self._expected(network="BK"), stream)
+
+    def test_duplicates(self):
+        filename = os.path.join(self.dirname, "output_p3.h5")
+        _writePartition(filename, self.velocity, [5, 6, 7])
+        stream = pylith.tostream_partitions(self.filenames + [filename], ORIGIN_TIME)
+        self.assertEqual(3*40, len(stream))
+        self._checkStream(self._expected(), stream)
+
+    def test_time_mismatch(self):
+        filename = os.path.join(self.dirname, "output_p3.h5")
+        _writePartition(filename, self.velocity, [40-1], dt=0.1)
+        with mock.patch.object(pylith, "_readColumns", wraps=pylith._readColumns) as reader:
+            with self.assertRaises(ValueError):
+                pylith.tostream_partitions(self.filenames + [filename], ORIGIN_TIME)
+            self.assertEqual(0, reader.call_count)
+
+        _writePartition(filename, self.velocity[:-1], [40-1])
+        with self.assertRaises(ValueError):
+            pylith.tostream_partitions([filename] + self.filenames, ORIGIN_TIME)
+
+    def test_workers(self):
+        import concurrent.futures
+        expected = self._expected(region=(-121.9, -121.0, 37.0, 38.0))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            for workers in (2, executor):
+                stream = pylith.tostream_partitions(self.filenames, ORIGIN_TIME, region=(-121.9, -121.0, 37.0, 38.0), workers=workers)
+                self._checkStream(expected, stream)
+
+    def test_empty(self):
+        self.assertEqual(0, len(pylith.tostream_partitions([], ORIGIN_TIME)))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
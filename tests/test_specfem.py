@@ -0,0 +1,236 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import os
+import resource
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+import obspy
+
+from obspyutils import specfem
+
+
+# ----------------------------------------------------------------------
+def _writeRun(dirname, nstations=3, npts=50, seed=0):
+    """
+    Write stations file and ASCII velocity seismograms.
+    """
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(os.path.join(dirname, "DATA"))
+    os.makedirs(os.path.join(dirname, "OUTPUT_FILES"))
+    with open(os.path.join(dirname, "DATA", "STATIONS_FILTERED"), "w") as fout:
+        for i in range(nstations):
+            fout.write("S%02d BK %.4f %.4f 10.0 0.0\n" % (i, 37.0+0.1*i, -122.0+0.1*i))
+            for component in "ENZ":
+                t = -1.0 + 0.01*numpy.arange(npts)
+                filename = os.path.join(dirname, "OUTPUT_FILES", "S%02d.BK.HX%s.semv" % (i, component))
+                numpy.savetxt(filename, numpy.column_stack((t, rng.standard_normal(npts))), fmt="%18.7E")
+    return
+
+
+# ----------------------------------------------------------------------
+def _writeBinary(dirname, dtype):
+    """
+    Write binary copies of ASCII seismograms.
+    """
+    for filename in os.listdir(os.path.join(dirname, "OUTPUT_FILES")):
+        filename = os.path.join(dirname, "OUTPUT_FILES", filename)
+        numpy.loadtxt(filename).astype(dtype).tofile(filename + ".bin")
+    return
+
+
+# ----------------------------------------------------------------------
+class TestToObspyApp(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        _writeRun(self.dirname)
+
+        app = specfem.ToObspyApp()
+        app.filenameIn = os.path.join(self.dirname, "DATA", "STATIONS_FILTERED")
+        app.dataDir = os.path.join(self.dirname, "OUTPUT_FILES")
+        app.filenameOut = os.path.join(self.dirname, "waveforms.dat")
+        app.originTime = obspy.UTCDateTime(2020, 1, 1)
+        app.channelCode = "HX"
+        app.dataType = "vel"
+        self.app = app
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _expected(self):
+        app = self.app
+        return specfem.tostream(app.filenameIn, app.dataDir, app.originTime, app.channelCode, app.dataType)
+
+    def test_run(self):
+        from obspyutils import store
+        self.app.epicenter = (-121.9, 37.1)
+        self.app.utmZone = 10
+        self.app.run()
+
+        stream = store.read(self.app.filenameOut)
+        expected = self._expected()
+        self.assertEqual(len(expected), len(stream))
+        for trE,tr in zip(expected, stream):
+            self.assertEqual(trE.id, tr.id)
+            self.assertEqual(trE.stats.starttime, tr.stats.starttime)
+            self.assertEqual(trE.stats.delta, tr.stats.delta)
+            self.assertIn('azimuth', tr.stats)
+            self.assertIn('distance', tr.stats)
+            numpy.testing.assert_array_equal(trE.data, tr.data)
+
+    def test_incremental(self):
+        self.app.incremental = True
+        with mock.patch.object(specfem, "_readAscii", wraps=specfem._readAscii) as reader:
+            self.app.run()
+            self.assertEqual(9, reader.call_count)
+
+            # Unchanged files are not read again.
+            reader.reset_mock()
+            self.app.run()
+            self.assertEqual(0, reader.call_count)
+
+            # Only the modified file is read again.
+            filename = os.path.join(self.app.dataDir, "S01.BK.HXN.semv")
+            raw = numpy.loadtxt(filename)
+            raw[:,1] *= 2.0
+            numpy.savetxt(filename, raw, fmt="%18.7E")
+            stat = os.stat(filename)
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            reader.reset_mock()
+            self.app.run()
+            self.assertEqual([mock.call(filename)], reader.call_args_list)
+
+        from obspyutils import store
+        stream = store.read(self.app.filenameOut)
+        expected = self._expected()
+        self.assertEqual([tr.id for tr in expected], [tr.id for tr in stream])
+        for trE,tr in zip(expected, stream):
+            numpy.testing.assert_array_equal(trE.data, tr.data)
+
+
+# ----------------------------------------------------------------------
+class TestReadBinary(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp(suffix=".semv.bin")
+        os.close(fd)
+        self.t = (-1.0 + 0.01*numpy.arange(25)).astype(numpy.float32)
+        self.values = numpy.linspace(-2.0, 3.0, 25).astype(numpy.float32)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def _check(self, dtype="float32"):
+        (t, values) = specfem._readBinary(self.filename, dtype)
+        numpy.testing.assert_array_equal(self.t.astype(dtype), t)
+        numpy.testing.assert_array_equal(self.values.astype(dtype), values)
+        self.assertTrue(values.flags.c_contiguous)
+
+    def test_raw(self):
+        numpy.column_stack((self.t, self.values)).tofile(self.filename)
+        self._check()
+        numpy.column_stack((self.t, self.values)).astype(numpy.float64).tofile(self.filename)
+        self._check("float64")
+
+    def test_fortran_records(self):
+        records = numpy.zeros(self.t.shape[0], dtype=[('head', numpy.int32), ('t', numpy.float32), ('value', numpy.float32), ('tail', numpy.int32)])
+        records['head'] = 8
+        records['tail'] = 8
+        records['t'] = self.t
+        records['value'] = self.values
+        records.tofile(self.filename)
+        self._check()
+
+    def test_size_mismatch(self):
+        numpy.zeros(7, dtype=numpy.float32).tofile(self.filename)
+        with self.assertRaises(IOError):
+            specfem._readBinary(self.filename, "float32")
+
+    def test_tostream(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            _writeRun(dirname, nstations=2)
+            for filename in os.listdir(os.path.join(dirname, "OUTPUT_FILES")):
+                filename = os.path.join(dirname, "OUTPUT_FILES", filename)
+                numpy.loadtxt(filename).tofile(filename + ".bin")
+            args = (os.path.join(dirname, "DATA", "STATIONS_FILTERED"), os.path.join(dirname, "OUTPUT_FILES"), obspy.UTCDateTime(2020, 1, 1))
+            expected = specfem.tostream(*args)
+            stream = specfem.tostream(*args, binary=True, dtype="float64")
+            for trE,tr in zip(expected, stream):
+                self.assertEqual(trE.stats, tr.stats)
+                numpy.testing.assert_array_equal(trE.data, tr.data)
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_open_files(self):
+        # Traces do not hold file descriptors, so more files than the
+        # descriptor limit can be converted.
+        dirname = tempfile.mkdtemp()
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        try:
+            _writeRun(dirname, nstations=40, npts=5)
+            _writeBinary(dirname, numpy.float32)
+            args = (os.path.join(dirname, "DATA", "STATIONS_FILTERED"), os.path.join(dirname, "OUTPUT_FILES"), obspy.UTCDateTime(2020, 1, 1))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (64, limits[1]))
+            stream = specfem.tostream(*args, binary=True)
+            self.assertEqual(120, len(stream))
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+            shutil.rmtree(dirname)
+
+
+# ----------------------------------------------------------------------
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        _writeRun(self.dirname, nstations=40, npts=20)
+        _writeBinary(self.dirname, numpy.float32)
+        self.args = (os.path.join(self.dirname, "DATA", "STATIONS_FILTERED"), os.path.join(self.dirname, "OUTPUT_FILES"), obspy.UTCDateTime(2020, 1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_traces(self):
+        expected = specfem.tostream(*self.args, binary=True)
+        with mock.patch.object(specfem, "_readBinary", wraps=specfem._readBinary) as reader:
+            traces = specfem.tostream(*self.args, binary=True, lazy=True, cacheSize=None)
+            self.assertEqual(0, reader.call_count)
+            self.assertEqual(len(expected), len(traces))
+            trace = traces[4]
+            self.assertEqual(1, reader.call_count)
+        self.assertEqual(expected[4].stats, trace.stats)
+        numpy.testing.assert_array_equal(expected[4].data, trace.data)
+        for trE,tr in zip(expected, traces):
+            self.assertEqual(trE.stats, tr.stats)
+            numpy.testing.assert_array_equal(trE.data, tr.data)
+
+    def test_open_files(self):
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (64, limits[1]))
+            traces = specfem.tostream(*self.args, binary=True, lazy=True, cacheSize=None)
+            stream = traces.stream()
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        self.assertEqual(120, len(stream))
+
+    def test_ascii(self):
+        with self.assertRaises(ValueError):
+            specfem.tostream(*self.args, lazy=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file
@@ -0,0 +1,99 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy
+import obspy
+
+from obspyutils import store
+
+
+# ----------------------------------------------------------------------
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        traces = [obspy.core.Trace(numpy.arange(7, dtype=numpy.int32), header={'network': "BK", 'station': "AAA", 'channel': "HNE"}),
+                  obspy.core.Trace(numpy.linspace(0.0, 1.0, 13)[::2], header={'network': "BK", 'station': "BBB", 'channel': "HNN"}),
+                  obspy.core.Trace(numpy.zeros(0), header={'network': "NC", 'station': "CCC", 'channel': "HNZ"}),
+                  ]
+        traces[1].stats.latitude = 37.5
+        traces[1].stats.starttime = obspy.UTCDateTime(2020, 1, 2, 3, 4, 5.678901)
+        traces[1].stats.processing = ["filter(options={'freq': 1.0})"]
+        traces[2].stats.event = {'origin_time': obspy.UTCDateTime(2020, 1, 2, 3, 4, 0.5), 'magnitude': 4.5}
+        self.stream = obspy.core.Stream(traces=traces)
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+        store.write(self.filename, self.stream)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_roundtrip(self):
+        for mmap in (True, False):
+            stream = store.read(self.filename, mmap=mmap)
+            self.assertEqual(len(self.stream), len(stream))
+            for trE,tr in zip(self.stream, stream):
+                self.assertEqual(trE.stats, tr.stats)
+                self.assertEqual(trE.data.dtype, tr.data.dtype)
+                numpy.testing.assert_array_equal(trE.data, tr.data)
+
+    def test_select(self):
+        stream = store.read(self.filename, station="b*")
+        self.assertEqual(["BK.BBB..HNN"], [tr.id for tr in stream])
+
+        # Copy-on-write: modifying data does not change file.
+        stream[0].data[0] = 99.0
+        self.assertEqual(0.0, store.read(self.filename, station="BBB")[0].data[0])
+
+    def test_index(self):
+        (dataStart, header) = store.read_index(self.filename)
+        self.assertEqual([tr.id for tr in self.stream], [entry['id'] for entry in header])
+        self.assertEqual(0, dataStart % store.ALIGNMENT)
+
+    def test_json_header(self):
+        with open(self.filename, "rb") as fin:
+            fin.seek(len(store.MAGIC))
+            headerSize = int(numpy.frombuffer(fin.read(8), dtype="<u8")[0])
+            header = json.loads(fin.read(headerSize).decode("utf-8"))
+        stats = header['traces'][1]['stats']
+        self.assertEqual({'__UTCDateTime__': "2020-01-02T03:04:05.678901Z"}, stats['starttime'])
+        self.assertEqual(37.5, stats['latitude'])
+
+        stats = store.read(self.filename, station="CCC")[0].stats
+        self.assertEqual(obspy.UTCDateTime(2020, 1, 2, 3, 4, 0.5), stats.event.origin_time)
+
+    def test_numpy_stats(self):
+        stream = self.stream.copy()
+        stream[0].stats.magnitude = numpy.float32(4.5)
+        stream[0].stats.depths = numpy.array([1.0, 2.0])
+        store.write(self.filename, stream)
+        stats = store.read(self.filename, station="AAA")[0].stats
+        self.assertEqual(4.5, stats.magnitude)
+        self.assertEqual([1.0, 2.0], stats.depths)
+
+    def test_unsupported(self):
+        stream = self.stream.copy()
+        stream[0].stats.response = object()
+        with self.assertRaises(TypeError):
+            store.write(self.filename, stream)
+
+    def test_bad_file(self):
+        with open(self.filename, "wb") as fout:
+            fout.write(b"not a stream file")
+        with self.assertRaises(IOError):
+            store.read(self.filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# End of file